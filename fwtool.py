@@ -5,12 +5,20 @@ from __future__ import print_function
 import argparse
 from collections import OrderedDict
 import io
+import multiprocessing
 import os
 import shutil
 from stat import *
 import sys
+import threading
 import yaml
 
+try:
+ import queue
+except ImportError:
+ # Python 2
+ import Queue as queue
+
 from fwtool import archive, lzh, pe, zip
 from fwtool.io import *
 from fwtool.sony import ash, bootloader, dat, dslr, fdat, flash, msfirm, wbi
@@ -26,31 +34,106 @@ def mkdirs(path):
 def setmtime(path, time):
  os.utime(path, (time, time))
 
-def writeFileTree(files, path):
+class FileWriter(object):
+ """Writes files to disk. The contents are read on the calling thread, the writes are done by a pool of writer threads"""
+ chunkSize = 0x100000
+
+ def __init__(self, workers=0, queueSize=4):
+  self._queues = [queue.Queue(queueSize) for i in range(workers)]
+  self._threads = [threading.Thread(target=self._run, args=(q,)) for q in self._queues]
+  self._next = 0
+  self._error = None
+  for thread in self._threads:
+   thread.daemon = True
+   thread.start()
+
+ def _run(self, q):
+  while True:
+   item = q.get()
+   if item is None:
+    break
+   dstFile, data = item
+   try:
+    if data is None:
+     dstFile.close()
+    elif self._error is None:
+     dstFile.write(data)
+   except Exception as e:
+    self._error = e
+
+ def write(self, fn, contents, headSize=0):
+  """Copies contents to the file fn. Returns the first headSize bytes of the contents"""
+  if self._error is not None:
+   raise self._error
+  dstFile = open(fn, 'wb')
+  q = self._queues[self._next % len(self._queues)] if self._queues else None
+  self._next += 1
+
+  head = b''
+  try:
+   for data in iter(lambda: contents.read(self.chunkSize), b''):
+    if len(head) < headSize:
+     head += data[:headSize-len(head)]
+    if q:
+     q.put((dstFile, data))
+    else:
+     dstFile.write(data)
+  finally:
+   # The file is closed even if reading its contents fails
+   if q:
+    q.put((dstFile, None))
+   else:
+    dstFile.close()
+  return head
+
+ def close(self):
+  for q in self._queues:
+   q.put(None)
+  for thread in self._threads:
+   thread.join()
+  if self._error is not None:
+   raise self._error
+
+ def __enter__(self):
+  return self
+
+ def __exit__(self, type, value, traceback):
+  try:
+   self.close()
+  except Exception as e:
+   if type is None:
+    raise
+   # Do not hide the exception which is already propagating, chain the writer error to it
+   if getattr(value, '__cause__', None) is None:
+    value.__cause__ = e
+
+def writeFileTree(files, path, workers=0):
  """Writes a list of UnixFiles to the disk, unpacking known archive files"""
- files = [(path + file.path, file) for file in files]
+ written = []
+ archives = []
 
  # Write files:
- for fn, file in files:
-  if S_ISDIR(file.mode):
-   mkdirs(fn)
-  elif S_ISREG(file.mode):
-   mkdirs(os.path.dirname(fn))
-   with open(fn, 'wb') as dstFile:
-    shutil.copyfileobj(file.contents, dstFile)
+ with FileWriter(workers) as writer:
+  for file in files:
+   fn = path + file.path
+   if S_ISDIR(file.mode):
+    mkdirs(fn)
+   elif S_ISREG(file.mode):
+    mkdirs(os.path.dirname(fn))
+    if archive.isArchive(writer.write(fn, file.contents, archive.headerSize)):
+     archives.append(fn)
+   written.append((fn, file.mode, file.mtime))
 
  # Recursion:
- for fn, file in files:
-  if S_ISREG(file.mode):
-   with open(fn, 'rb') as dstFile:
-    if archive.isArchive(dstFile):
-     print('Unpacking %s' % fn)
-     writeFileTree(archive.readArchive(dstFile), fn + '_unpacked')
+ for fn in archives:
+  with open(fn, 'rb') as dstFile:
+   print('Unpacking %s' % fn)
+   writeFileTree(archive.readArchive(dstFile, workers), fn + '_unpacked', workers)
 
  # Set mtimes:
- for fn, file in files:
-  if S_ISDIR(file.mode) or S_ISREG(file.mode):
-   setmtime(fn, file.mtime)
+ for fn, mode, mtime in written:
+  if S_ISDIR(mode) or S_ISREG(mode):
+   setmtime(fn, mtime)
 
 def toUnixFile(path, file, mtime=0):
  return archive.UnixFile(
@@ -121,14 +204,14 @@ def unpackDat(datFile, fdatFile):
  }
 
 
-def unpackFdat(fdatFile, outDir, mtime):
+def unpackFdat(fdatFile, outDir, mtime, workers=0):
  print('Extracting files')
  fdatContents = fdat.readFdat(fdatFile)
 
  writeFileTree([
   toUnixFile('/firmware.tar', fdatContents.firmware, mtime),
   toUnixFile('/updater.img', fdatContents.fs, mtime),
- ], outDir)
+ ], outDir, workers)
 
  return {
   'model': fdatContents.model,
@@ -138,11 +221,11 @@ def unpackFdat(fdatFile, outDir, mtime):
  }
 
 
-def unpackMsFirm(file, outDir):
+def unpackMsFirm(file, outDir, workers=0):
  print('Decrypting firmware image')
  crypterName, msFirmContents = msfirm.readMsFirm(file)
 
- writeFileTree(msFirmContents.files, outDir)
+ writeFileTree(msFirmContents.files, outDir, workers)
 
  return {
   'crypterName': crypterName,
@@ -153,13 +236,13 @@ def unpackMsFirm(file, outDir):
  }
 
 
-def unpackAsh(file, outDir, mtime):
+def unpackAsh(file, outDir, mtime, workers=0):
  print('Decrypting firmware image')
  ashContents = ash.readAsh(file)
 
  writeFileTree([
   toUnixFile('/firmware.dat', ashContents.firmware, mtime),
- ], outDir)
+ ], outDir, workers)
 
  return {
   'model': ashContents.model,
@@ -168,7 +251,7 @@ def unpackAsh(file, outDir, mtime):
  }
 
 
-def unpackDslr(file, outDir, mtime):
+def unpackDslr(file, outDir, mtime, workers=0):
  print('Decrypting firmware image')
  firmware = dslr.decryptDslrFirmware(file)
  contents = dslr.readDslrFirmware(firmware)
@@ -176,7 +259,7 @@ def unpackDslr(file, outDir, mtime):
  firmware.seek(0)
  writeFileTree([
   toUnixFile('/firmware.dat', firmware, mtime),
- ] + [toUnixFile('/unpacked/' + n, f, mtime) for n, f in contents.files], outDir)
+ ] + [toUnixFile('/unpacked/' + n, f, mtime) for n, f in contents.files], outDir, workers)
 
  return {
   'model': contents.model,
@@ -184,28 +267,29 @@ def unpackDslr(file, outDir, mtime):
  }
 
 
-def unpackDump(dumpFile, outDir, mtime):
+def unpackDump(dumpFile, outDir, mtime, workers=0):
  print('Extracting partitions')
- writeFileTree((toUnixFile('/nflasha%d' % i, f, mtime) for i, f in flash.readPartitionTable(dumpFile)), outDir)
+ writeFileTree((toUnixFile('/nflasha%d' % i, f, mtime) for i, f in flash.readPartitionTable(dumpFile)), outDir, workers)
 
 
-def unpackBootloader(file, outDir, mtime):
+def unpackBootloader(file, outDir, mtime, workers=0):
  print('Extracting bootloader partition')
  files = list(bootloader.readBootloader(file))
- writeFileTree((toUnixFile('/' + f.name, f.contents, mtime) for f in files), outDir)
+ writeFileTree((toUnixFile('/' + f.name, f.contents, mtime) for f in files), outDir, workers)
  with open(outDir + '/bootfiles.yaml', 'w') as yamlFile:
   writeYaml([{f.name: {'version': f.version, 'loadaddr': f.loadaddr}} for f in files], yamlFile)
 
 
-def unpackWbi(file, outDir, mtime):
+def unpackWbi(file, outDir, mtime, workers=0):
  print('Extracting warm boot image')
- writeFileTree((toUnixFile('/0x%08x.dat' % c.physicalAddr, c.contents, mtime) for c in wbi.readWbi(file)), outDir)
+ writeFileTree((toUnixFile('/0x%08x.dat' % c.physicalAddr, c.contents, mtime) for c in wbi.readWbi(file, workers)), outDir, workers)
 
 
-def unpackCommand(file, outDir):
+def unpackCommand(file, outDir, workers=0):
  """Extracts the input file to the specified directory"""
  mkdirs(outDir)
  mtime = os.stat(file.name).st_mtime
+ file = mapFile(file)
 
  datConf = None
  fdatConf = None
@@ -217,21 +301,21 @@ def unpackCommand(file, outDir):
  if dat.isDat(file):
   with open(outDir + '/firmware.fdat', 'w+b') as fdatFile:
    datConf = unpackDat(file, fdatFile)
-   fdatConf = unpackFdat(fdatFile, outDir, mtime)
+   fdatConf = unpackFdat(fdatFile, outDir, mtime, workers)
  elif fdat.isFdat(file):
-  fdatConf = unpackFdat(file, outDir, mtime)
+  fdatConf = unpackFdat(file, outDir, mtime, workers)
  elif msfirm.isMsFirm(file):
-  datConf, fdatConf = unpackMsFirm(file, outDir)
+  datConf, fdatConf = unpackMsFirm(file, outDir, workers)
  elif ash.isAsh(file):
-  fdatConf = unpackAsh(file, outDir, mtime)
+  fdatConf = unpackAsh(file, outDir, mtime, workers)
  elif dslr.isDslrFirmware(file):
-  fdatConf = unpackDslr(file, outDir, mtime)
+  fdatConf = unpackDslr(file, outDir, mtime, workers)
  elif flash.isPartitionTable(file):
-  unpackDump(file, outDir, mtime)
+  unpackDump(file, outDir, mtime, workers)
  elif bootloader.isBootloader(file):
-  unpackBootloader(file, outDir, mtime)
+  unpackBootloader(file, outDir, mtime, workers)
  elif wbi.isWbi(file):
-  unpackWbi(file, outDir, mtime)
+  unpackWbi(file, outDir, mtime, workers)
  else:
   raise Exception('Unknown file type!')
 
@@ -239,7 +323,33 @@ def unpackCommand(file, outDir):
   writeYaml({'dat': datConf, 'fdat': fdatConf}, yamlFile)
 
 
-def packCommand(firmwareFile, fsFile, bodyFile, configFile, device, outDir, defaultVersion='9.99'):
+def writePackedDat(datConf, encrypted, outDir):
+ with open(outDir + '/firmware_packed.dat', 'w+b') as datFile:
+  dat.writeDat(dat.DatFile(
+   normalUsbDescriptors = datConf['normalUsbDescriptors'],
+   updaterUsbDescriptors = datConf['updaterUsbDescriptors'],
+   isLens = datConf['isLens'],
+   firmwareData = encrypted,
+  ), datFile)
+
+
+def packDat(datConf, fdatFile, outDir, oldDir=None):
+ """Encrypts a FDAT file to firmware_packed.dat. If oldDir is set, unchanged parts of its encrypted image are reused"""
+ if fdat.isSignedCrypter(datConf['crypterName']):
+  print('Warning: %s firmware images are signed. The packed image is not signed and will probably be rejected by the camera' % datConf['crypterName'])
+ if oldDir:
+  print('Encrypting firmware image, reusing unchanged parts of %s' % oldDir)
+  if not os.path.exists(oldDir + '/firmware_packed.fdat'):
+   raise Exception('No firmware_packed.fdat found in %s, it has to be packed with -k or -i' % oldDir)
+  with open(oldDir + '/firmware_packed.fdat', 'rb') as oldFdatFile, open(oldDir + '/firmware_packed.dat', 'rb') as oldDatFile:
+   oldDat = dat.readDat(mapFile(oldDatFile))
+   writePackedDat(datConf, fdat.encryptFdat(fdatFile, datConf['crypterName'], mapFile(oldFdatFile), oldDat.firmwareData), outDir)
+ else:
+  print('Encrypting firmware image')
+  writePackedDat(datConf, fdat.encryptFdat(fdatFile, datConf['crypterName']), outDir)
+
+
+def packCommand(firmwareFile, fsFile, bodyFile, configFile, device, outDir, defaultVersion='9.99', workers=0, compressionLevel=9, dedup=False, oldDir=None, keepFiles=False):
  mkdirs(outDir)
 
  if configFile:
@@ -267,37 +377,43 @@ def packCommand(firmwareFile, fsFile, bodyFile, configFile, device, outDir, defa
 
  isMsFirm = datConf and datConf['crypterName'].endswith('_ms')
 
+ if oldDir and isMsFirm:
+  raise Exception('Incremental packing is not supported for this firmware')
+ if oldDir and os.path.realpath(oldDir) == os.path.realpath(outDir):
+  raise Exception('The previous output directory cannot be overwritten')
+
  if not fsFile and bodyFile:
   print('Packing updater file system')
-  fsFile = open(outDir + '/updater_packed.img', 'w+b')
+  fsFile = open(outDir + '/updater_packed.img', 'w+b') if keepFiles else io.BytesIO()
   path = '/bodylib/libupdaterbody.so' if not isMsFirm else '/BodyUdtr.sh'
-  archive.cramfs.writeCramfs([toUnixFile(path, bodyFile)], fsFile)
+  saved = archive.cramfs.writeCramfs([toUnixFile(path, bodyFile)], fsFile, workers, compressionLevel, dedup)
+  if dedup:
+   print('Deduplication saved %d bytes' % saved)
 
  if fdatConf:
   print('Creating firmware image')
-  with open(outDir + '/firmware_packed.fdat', 'w+b') as fdatFile:
-   if not isMsFirm:
-    fdat.writeFdat(fdat.FdatFile(
-     model = fdatConf['model'],
-     region = fdatConf['region'],
-     version = fdatConf['version'],
-     isAccessory = fdatConf['isAccessory'],
-     firmware = firmwareFile if firmwareFile else io.BytesIO(),
-     fs = fsFile if fsFile else io.BytesIO(),
-    ), fdatFile)
-
-    if datConf:
-     print('Encrypting firmware image')
-     encrypted = fdat.encryptFdat(fdatFile, datConf['crypterName'])
-     with open(outDir + '/firmware_packed.dat', 'w+b') as datFile:
-      dat.writeDat(dat.DatFile(
-       normalUsbDescriptors = datConf['normalUsbDescriptors'],
-       updaterUsbDescriptors = datConf['updaterUsbDescriptors'],
-       isLens = datConf['isLens'],
-       firmwareData = encrypted,
-      ), datFile)
-
+  if not isMsFirm:
+   fdatContents = fdat.FdatFile(
+    model = fdatConf['model'],
+    region = fdatConf['region'],
+    version = fdatConf['version'],
+    isAccessory = fdatConf['isAccessory'],
+    firmware = firmwareFile if firmwareFile else io.BytesIO(),
+    fs = fsFile if fsFile else io.BytesIO(),
+   )
+
+   if datConf and not keepFiles and not oldDir:
+    # The image is generated while it is encrypted
+    packDat(datConf, fdat.packFdat(fdatContents), outDir, oldDir)
    else:
+    # Incremental builds keep the FDAT file, so that the next incremental build can be based on them
+    with open(outDir + '/firmware_packed.fdat', 'w+b') as fdatFile:
+     fdat.writeFdat(fdatContents, fdatFile)
+     if datConf:
+      packDat(datConf, fdatFile, outDir, oldDir)
+
+  else:
+   with open(outDir + '/firmware_packed.fdat', 'w+b') as fdatFile:
     msfirm.writeMsFirm(datConf['crypterName'], msfirm.MsFirmFile(
      model = fdatConf['model'],
      region = fdatConf['region'],
@@ -314,11 +430,13 @@ def listDevicesCommand():
 
 def main():
  """Command line main"""
+ multiprocessing.freeze_support()
  parser = argparse.ArgumentParser()
  subparsers = parser.add_subparsers(dest='command', title='commands')
  unpack = subparsers.add_parser('unpack', description='Unpack a firmware file')
  unpack.add_argument('-f', dest='inFile', type=argparse.FileType('rb'), required=True, help='input file')
  unpack.add_argument('-o', dest='outDir', required=True, help='output directory')
+ unpack.add_argument('-j', dest='workers', type=int, default=0, help='number of decompression processes and file writer threads')
  pack = subparsers.add_parser('pack', description='Pack a firmware file')
  packConfig = pack.add_mutually_exclusive_group(required=True)
  packConfig.add_argument('-c', dest='configFile', type=argparse.FileType('rb'), help='configuration file (config.yaml)')
@@ -328,13 +446,18 @@ def main():
  packBody.add_argument('-b', dest='updaterBodyFile', type=argparse.FileType('rb'), help='updater body file (libupdaterbody.so)')
  pack.add_argument('-f', dest='firmwareFile', type=argparse.FileType('rb'), help='firmware file (firmware.tar)')
  pack.add_argument('-o', dest='outDir', required=True, help='output directory')
+ pack.add_argument('-j', dest='workers', type=int, default=0, help='number of worker threads')
+ pack.add_argument('-z', dest='compressionLevel', type=int, default=9, choices=range(10), metavar='LEVEL', help='compression level of the updater file system (0-9)')
+ pack.add_argument('-s', dest='dedup', action='store_true', help='deduplicate identical files and blocks in the updater file system')
+ pack.add_argument('-i', dest='oldDir', help='output directory of a previous pack command run with -k or -i, to reuse unchanged encrypted blocks from. firmware_packed.fdat is always kept with -i')
+ pack.add_argument('-k', dest='keepFiles', action='store_true', help='keep the intermediate files (updater_packed.img, firmware_packed.fdat). The output can only be used with -i if firmware_packed.fdat is kept')
  subparsers.add_parser('list_devices', description='List all known devices')
 
  args = parser.parse_args()
  if args.command == 'unpack':
-  unpackCommand(args.inFile, args.outDir)
+  unpackCommand(args.inFile, args.outDir, args.workers)
  elif args.command == 'pack':
-  packCommand(args.firmwareFile, args.updaterFile, args.updaterBodyFile, args.configFile, args.device, args.outDir)
+  packCommand(args.firmwareFile, args.updaterFile, args.updaterBodyFile, args.configFile, args.device, args.outDir, workers=args.workers, compressionLevel=args.compressionLevel, dedup=args.dedup, oldDir=args.oldDir, keepFiles=args.keepFiles)
  elif args.command == 'list_devices':
   listDevicesCommand()
  else:
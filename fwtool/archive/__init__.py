@@ -4,26 +4,48 @@ UnixFile = namedtuple('UnixFile', 'path, size, mtime, mode, uid, gid, contents')
 
 from . import axfs, cpio, cramfs, ext2, fat, gz, lzpt, squashfs, tar
 
+# (header, [(field, magic), ...], read function), in order of precedence
+_types = [
+ (axfs.AxfsHeader, [('magic', axfs.axfsHeaderMagic), ('signature', axfs.axfsHeaderSignature)], axfs.readAxfs),
+ (cpio.CpioHeader, [('magic', cpio.cpioHeaderMagic)], cpio.readCpio),
+ (cramfs.CramfsSuper, [('magic', cramfs.cramfsSuperMagic), ('signature', cramfs.cramfsSuperSignature)], cramfs.readCramfs),
+ (ext2.Ext2Header, [('magic', ext2.ext2HeaderMagic)], ext2.readExt2),
+ (fat.FatHeader, [('signature', fat.fatHeaderSignature), ('extendedSignature', fat.fatHeaderExtendedSignature), ('fsType', b'FAT')], fat.readFat),
+ (gz.GzipHeader, [('magic', gz.gzipHeaderMagic)], gz.readGzip),
+ (lzpt.LzptHeader, [('magic', lzpt.lzptHeaderMagic)], lzpt.readLzpt),
+ (squashfs.SquashfsSuper, [('magic', squashfs.squashfsSuperMagic)], squashfs.readSquashfs),
+] + [(tar.TarHeader, [('magic', magic)], tar.readTar) for magic in tar.tarHeaderMagic]
+
+_parallelReaders = [lzpt.readLzpt]
+
+# The number of bytes needed to detect any archive type
+headerSize = max(header.size for header, signature, read in _types)
+
+# (offset, length) -> magic -> indices of the types checking it
+_signatures = {}
+for i, (header, signature, read) in enumerate(_types):
+ for field, magic in signature:
+  _signatures.setdefault((header.offsets[field], len(magic)), {}).setdefault(magic, []).append(i)
+
 def _findType(data):
- types = [
-  (axfs.isAxfs, axfs.readAxfs),
-  (cpio.isCpio, cpio.readCpio),
-  (cramfs.isCramfs, cramfs.readCramfs),
-  (ext2.isExt2, ext2.readExt2),
-  (fat.isFat, fat.readFat),
-  (gz.isGzip, gz.readGzip),
-  (lzpt.isLzpt, lzpt.readLzpt),
-  (squashfs.isSquashfs, squashfs.readSquashfs),
-  (tar.isTar, tar.readTar),
- ]
-
- for detect, read in types:
-  if detect(data):
+ if not isinstance(data, (bytes, bytearray, memoryview)):
+  data.seek(0)
+  data = data.read(headerSize)
+
+ matches = [0] * len(_types)
+ for (offset, length), magics in _signatures.items():
+  for i in magics.get(bytes(data[offset:offset+length]), []):
+   matches[i] += 1
+
+ for (header, signature, read), n in zip(_types, matches):
+  if n == len(signature) and len(data) >= header.size:
    return read
  return None
 
 def isArchive(data):
+ """Checks if data (a file or its first headerSize bytes) is a known archive"""
  return _findType(data) is not None
 
-def readArchive(data):
- return _findType(data)(data)
+def readArchive(data, workers=0):
+ read = _findType(data)
+ return read(data, workers) if read in _parallelReaders else read(data)
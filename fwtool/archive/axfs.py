@@ -1,6 +1,8 @@
 """A parser for axfs file system images"""
 
+import array
 from stat import *
+import sys
 import zlib
 
 from . import *
@@ -54,6 +56,18 @@ axfsRegions = [
  'gids',
 ]
 
+def _parseTable(data, byteDepth, count):
+ """Decodes a table stored as byteDepth planes of count bytes each (least significant first) into an array"""
+ typecode = next(c for c in 'BHILQ' if array.array(c).itemsize >= byteDepth)
+ itemSize = array.array(typecode).itemsize
+ values = bytearray(count * itemSize)
+ for j in range(byteDepth):
+  values[j::itemSize] = data[j*count:(j+1)*count]
+ table = array.array(typecode, bytes(values))
+ if sys.byteorder == 'big':
+  table.byteswap()
+ return table
+
 def isAxfs(file):
  header = AxfsHeader.unpack(file)
  return header and header.magic == axfsHeaderMagic and header.signature == axfsHeaderSignature
@@ -69,8 +83,7 @@ def readAxfs(file):
   region = AxfsRegionDesc.unpack(file, parse64be(header.regions[i*8:(i+1)*8]))
   regions[k] = FilePart(file, region.offset, region.size)
   if i >= 4:
-   regionData = regions[k].read()
-   tables[k] = [sum([ord(regionData[j*region.maxIndex+i:j*region.maxIndex+i+1]) << (8*j) for j in range(region.tableByteDepth)]) for i in range(region.maxIndex)]
+   tables[k] = _parseTable(regions[k].read(), region.tableByteDepth, region.maxIndex)
 
  def readInode(id, path=''):
   size = tables['fileSize'][id]
@@ -1,6 +1,7 @@
 """A parser for cramfs file system images"""
 
 from collections import namedtuple, OrderedDict
+import hashlib
 import io
 import os
 import posixpath
@@ -69,11 +70,11 @@ def readCramfs(file):
   path += name
   isDir = S_ISDIR(inode.mode)
 
-  def generateChunks(offset=offset, size=size):
+  def generateChunks(start=0, offset=offset, size=size):
    nBlocks = (size - 1) // cramfsBlockSize + 1
    file.seek(offset)
    blockPointers = [offset + nBlocks * 4] + [parse32le(file.read(4)) for i in range(nBlocks)]
-   for i in range(len(blockPointers) - 1):
+   for i in range(start, len(blockPointers) - 1):
     file.seek(blockPointers[i])
     block = file.read(blockPointers[i+1] - blockPointers[i])
     yield decompress(block)
@@ -85,7 +86,7 @@ def readCramfs(file):
    mode = inode.mode,
    uid = inode.uid,
    gid = gid,
-   contents = ChunkedFile(generateChunks, size) if S_ISREG(inode.mode) or S_ISLNK(inode.mode) else None,
+   contents = ChunkedFile(generateChunks, size, seekableChunks=True) if S_ISREG(inode.mode) or S_ISLNK(inode.mode) else None,
   )
 
   if isDir:
@@ -105,7 +106,10 @@ def _pad(file, n, char=b'\0'):
  if off % n > 0:
   file.write(char * (n - off % n))
 
-def writeCramfs(files, outFile):
+def writeCramfs(files, outFile, workers=0, level=9, dedup=False):
+ """Writes a cramfs image. If workers > 0, blocks are compressed on a pool of threads.
+ If dedup is set, identical files share their data and repeated blocks are only compressed once.
+ Returns the number of bytes saved by deduplication."""
  files = {f.path: f for f in files}
  tree = {'': set()}
  for path in files:
@@ -132,7 +136,50 @@ def writeCramfs(files, outFile):
   stack[file.path] = StackItem(offset, outFile.tell() - offset, file, childrenPaths)
   tail = tail[1:] + childrenPaths
 
+ sizes = {}
+ for item in stack.values():
+  if S_ISREG(item.file.mode) or S_ISLNK(item.file.mode):
+   item.file.contents.seek(0, os.SEEK_END)
+   sizes[item.file.path] = item.file.contents.tell()
+
+ # sources maps a file to the first file with the same contents, hashes lists the digests of its blocks
+ sources = {}
+ hashes = {}
+ if dedup:
+  firstFiles = {}
+  blockCounts = {}
+  for item in stack.values():
+   path = item.file.path
+   if path in sizes:
+    item.file.contents.seek(0)
+    hashes[path] = [hashlib.sha1(item.file.contents.read(cramfsBlockSize)).digest() for i in range((sizes[path] - 1) // cramfsBlockSize + 1)]
+    key = tuple(hashes[path])
+    if key in firstFiles:
+     sources[path] = firstFiles[key]
+    else:
+     firstFiles[key] = path
+     for digest in hashes[path]:
+      blockCounts[digest] = blockCounts.get(digest, 0) + 1
+
+ def readBlocks():
+  compressed = set()
+  for item in stack.values():
+   path = item.file.path
+   if path in sizes and path not in sources:
+    item.file.contents.seek(0)
+    for i in range((sizes[path] - 1) // cramfsBlockSize + 1):
+     block = item.file.contents.read(cramfsBlockSize)
+     if dedup:
+      if hashes[path][i] in compressed:
+       continue
+      compressed.add(hashes[path][i])
+     yield block, level
+ compressedBlocks = parallelMap(zlib.compress, readBlocks(), workers, threads=True)
+
  blocks = 0
+ saved = 0
+ dataSpans = {}
+ blockCache = {}
  for item in stack.values():
   if S_ISDIR(item.file.mode):
    if item.childrenPaths:
@@ -141,23 +188,39 @@ def writeCramfs(files, outFile):
    else:
     offset = 0
     size = 0
+  elif (S_ISREG(item.file.mode) or S_ISLNK(item.file.mode)) and item.file.path in sources:
+   # Point to the data of the identical file written before
+   offset, span = dataSpans[sources[item.file.path]]
+   size = sizes[item.file.path]
+   saved += span
   elif S_ISREG(item.file.mode) or S_ISLNK(item.file.mode):
    offset = outFile.tell()
-   item.file.contents.seek(0, os.SEEK_END)
-   size = item.file.contents.tell()
+   size = sizes[item.file.path]
 
    nBlocks = (size - 1) // cramfsBlockSize + 1
    blocks += nBlocks
-   outFile.write(b'\0' * (nBlocks * 4))
 
-   item.file.contents.seek(0)
+   # Write the blocks after the pointer table, then the pointers in one go
+   o = offset + nBlocks * 4
+   outFile.seek(o)
+   blockPointers = []
    for i in range(nBlocks):
-    outFile.write(zlib.compress(item.file.contents.read(cramfsBlockSize), 9))
-    o = outFile.tell()
-    outFile.seek(offset + i * 4)
-    outFile.write(dump32le(o))
-    outFile.seek(o)
+    digest = hashes[item.file.path][i] if dedup else None
+    if digest in blockCache:
+     # Block pointers can only describe consecutive blocks, so repeated blocks are stored again but not recompressed
+     block = blockCache[digest]
+    else:
+     block = next(compressedBlocks)
+     if dedup and blockCounts[digest] > 1:
+      blockCache[digest] = block
+    outFile.write(block)
+    o += len(block)
+    blockPointers.append(dump32le(o))
+   outFile.seek(offset)
+   outFile.write(b''.join(blockPointers))
+   outFile.seek(o)
    _pad(outFile, 4)
+   dataSpans[item.file.path] = offset, outFile.tell() - offset
   else:
    offset = 0
    size = item.file.size
@@ -193,3 +256,5 @@ def writeCramfs(files, outFile):
  crc = crc32(outFile)
  outFile.seek(32)
  outFile.write(dump32le(crc))
+
+ return saved
@@ -65,7 +65,7 @@ def readExt2(file):
 
  bdgOffset = max(blockSize, 2048)
  numBlockGroups = (header.blocksCount-1) // header.blocksPerGroup + 1
- inodeTables = [Ext2Bgd.unpack(file, bdgOffset + i * Ext2Bgd.size).inodeTableBlock for i in range(numBlockGroups)]
+ inodeTables = [bgd.inodeTableBlock for bgd in Ext2Bgd.iterUnpack(file, bdgOffset, numBlockGroups)]
 
  def readInode(i, path = ''):
   inode = Ext2Inode.unpack(file, inodeTables[(i-1) // header.inodesPerGroup] * blockSize + ((i-1) % header.inodesPerGroup) * header.inodeSize)
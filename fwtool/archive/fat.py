@@ -1,6 +1,6 @@
 """A parser for FAT file system images"""
 
-import io
+import os
 import posixpath
 import shutil
 from stat import *
@@ -75,11 +75,15 @@ def readFat(file):
  file.seek(fatOffset)
  if header.fsType == b'FAT12   ':
   endMarker = 0xfff
-  packedClusters = [parse32le(file.read(3) + b'\0') for i in range(0, header.sectorsPerFat * header.bytesPerSector, 3)]
-  clusters = [cluster for packed in packedClusters for cluster in [packed & 0xfff, (packed >> 12) & 0xfff]]
+  data = file.read(header.sectorsPerFat * header.bytesPerSector)
+  data += b'\0' * (-len(data) % 3)
+  # Every 3 bytes hold 2 entries
+  clusters = [0] * (len(data) // 3 * 2)
+  clusters[0::2] = [b0 | (b1 & 0xf) << 8 for b0, b1 in zip(data[0::3], data[1::3])]
+  clusters[1::2] = [b1 >> 4 | b2 << 4 for b1, b2 in zip(data[1::3], data[2::3])]
  elif header.fsType == b'FAT16   ':
   endMarker = 0xffff
-  clusters = [parse16le(file.read(2)) for i in range(0, header.sectorsPerFat * header.bytesPerSector, 2)]
+  clusters = parse16leArr(file.read(header.sectorsPerFat * header.bytesPerSector))
  else:
   raise Exception('Unknown FAT width')
 
@@ -87,13 +91,13 @@ def readFat(file):
   offset = 0
   vfatName = b''
   while entries[offset:offset+1] != b'\0':
-   entry = FatDirEntry.unpack(entries, offset)
+   entry = FatDirEntry.unpackFrom(entries, offset)
    if entry.name[0:1] == b'\xe5':
     vfatName = b''
    else:
     if entry.attr == 0x0f:
      # VFAT
-     vfatEntry = VfatDirEntry.unpack(entries, offset)
+     vfatEntry = VfatDirEntry.unpackFrom(entries, offset)
      vfatName = vfatEntry.name1 + vfatEntry.name2 + vfatEntry.name3 + vfatName
     else:
      if vfatName != b'':
@@ -111,8 +115,10 @@ def readFat(file):
       isLink = (entry.attr & 0x04) and (entry.ctimeCs & 0xe1) == 0x21
       isDir = entry.attr & 0x10
 
-      def generateChunks(cluster=entry.cluster, size=entry.size, isDir=isDir):
-       read = 0
+      def generateChunks(start=0, cluster=entry.cluster, size=entry.size, isDir=isDir):
+       for i in range(start):
+        cluster = clusters[cluster]
+       read = start * header.sectorsPerCluster * header.bytesPerSector
        while cluster != 0 and cluster != endMarker and (read < size or isDir):
         file.seek(dataOffset + (cluster - 2) * header.sectorsPerCluster * header.bytesPerSector)
         block = file.read(header.sectorsPerCluster * header.bytesPerSector)
@@ -120,7 +126,7 @@ def readFat(file):
         read += len(block)
         cluster = clusters[cluster]
 
-      contents = ChunkedFile(generateChunks, entry.size if not isDir else -1)
+      contents = ChunkedFile(generateChunks, entry.size if not isDir else -1, seekableChunks=True)
       yield UnixFile(
        path = path + '/' + name,
        size = entry.size,
@@ -143,6 +149,7 @@ def readFat(file):
 
 
 def writeFat(files, size, outFile):
+ """Writes a FAT12 or FAT16 image. The clusters of all files are planned first, so the data can be written sequentially."""
  files = {f.path: f for f in files}
  tree = {'': set()}
  for path in files:
@@ -153,90 +160,94 @@ def writeFat(files, size, outFile):
 
  sectorSize = 0x200
  clusterSize = 0x4000
-
- sectors = size // sectorSize
- fatSize = (size // clusterSize + 1) // 2 * 3
- fatSectors = (fatSize + sectorSize - 1) // sectorSize
-
- outFile.write(FatHeader.pack(
-  jump = b'\xeb\0\x90',
-  oemName = 8*b'\0',
-  bytesPerSector = sectorSize,
-  sectorsPerCluster = clusterSize // sectorSize,
-  reservedSectors = 1,
-  fatCopies = 1,
-  rootEntries = clusterSize // FatDirEntry.size,
-  sectors = sectors,
-  mediaDescriptor = 0xf8,
-  sectorsPerFat = fatSectors,
-  extendedSignature = fatHeaderExtendedSignature,
-  serialNumber = 0,
-  volumeLabel = 11*b' ',
-  fsType = b'FAT12   ',
-  signature = fatHeaderSignature,
- ))
- for i in range(sectors - 1):
-  outFile.write(sectorSize * b'\0')
-
- fatOffset = sectorSize
- rootOffset = fatOffset + fatSectors * sectorSize
- dataOffset = rootOffset + clusterSize
-
- clusters = [0xff8, 0xfff]
- def writeData(f):
-  f.seek(0)
-  outFile.seek(dataOffset + (len(clusters) - 2) * clusterSize)
-  shutil.copyfileobj(f, outFile)
-  nc = (f.tell() + clusterSize - 1) // clusterSize
-  for i in range(nc):
-   clusters.append(len(clusters) + 1 if i < nc-1 else 0xfff)
-  return (len(clusters)-nc if nc else 0), f.tell()
-
- def dirEntries(pc, c):
+ rootSize = clusterSize
+
+ # The FAT width is determined by the number of clusters
+ for fsType, bits in [(b'FAT12   ', 12), (b'FAT16   ', 16)]:
+  maxClusters = (1 << bits) - 12
+  fatSectors = (((size // clusterSize + 2) * bits + 7) // 8 + sectorSize - 1) // sectorSize
+  fatOffset = sectorSize
+  rootOffset = fatOffset + fatSectors * sectorSize
+  dataOffset = rootOffset + rootSize
+  dataClusters = (size - dataOffset) // clusterSize
+  if dataClusters <= maxClusters + 1:
+   dataClusters = min(dataClusters, maxClusters)
+   break
+ else:
+  raise Exception('Image too large')
+ if dataClusters < 0:
+  raise Exception('Image too small')
+ endMarker = (1 << bits) - 1
+
+ def getFile(path):
+  return files.get(path, UnixFile(path, 0, 0, S_IFDIR | 0o775, 0, 0, None))
+
+ def getNames(path):
+  name, ext = (posixpath.basename(path).upper() + '.').split('.', 1)
+  fn = posixpath.basename(path) + '\0'
+  return name[:8].ljust(8, ' ').encode('ascii'), ext[:3].ljust(3, ' ').encode('ascii'), [fn[o:o+13] for o in range(0, len(fn), 13)]
+
+ sizes = {}
+ for path in set(tree) | set(files):
+  file = getFile(path)
+  if S_ISDIR(file.mode):
+   sizes[path] = (2 if path != '' else 0) * FatDirEntry.size
+   for p in tree.get(path, set()):
+    sizes[path] += (len(getNames(p)[2]) + 1) * FatDirEntry.size
+  else:
+   file.contents.seek(0, os.SEEK_END)
+   sizes[path] = file.contents.tell()
+
+ if sizes[''] > rootSize:
+  raise Exception('Too many files in root directory')
+
+ # Plan the clusters: children are placed before their directory
+ clusters = [endMarker - 7, endMarker]
+ firstClusters = {'': 0}
+ dataPaths = []
+ def planDir(path):
+  for p in sorted(tree.get(path, set())):
+   if S_ISDIR(getFile(p).mode):
+    planDir(p)
+   n = (sizes[p] + clusterSize - 1) // clusterSize
+   firstClusters[p] = len(clusters) if n else 0
+   clusters.extend(range(len(clusters) + 1, len(clusters) + n))
+   if n:
+    clusters.append(endMarker)
+    dataPaths.append(p)
+ planDir('')
+
+ if len(clusters) - 2 > dataClusters:
+  raise Exception('Image too small')
+
+ def dirEntry(name, ext, attr, ctimeCs, t, cluster, size):
   return FatDirEntry.pack(
-    name = b'.       ',
-    ext = b'   ',
-    attr = 0x10,
-    ctimeCs = 0,
-    time = 0,
-    date = 0,
-    cluster = c,
-    size = 0,
-   ) + FatDirEntry.pack(
-    name = b'..      ',
-    ext = b'   ',
-    attr = 0x10,
-    ctimeCs = 0,
-    time = 0,
-    date = 0,
-    cluster = pc,
-    size = 0,
-   )
-
- dirs = {}
- def writeDir(path):
-  data = io.BytesIO()
+   name = name,
+   ext = ext,
+   attr = attr,
+   ctimeCs = ctimeCs,
+   time = (t.tm_hour << 11) + (t.tm_min << 5) + t.tm_sec // 2 if t else 0,
+   date = (max(t.tm_year - 1980, 0) << 9) + (t.tm_mon << 5) + t.tm_mday if t else 0,
+   cluster = cluster,
+   size = size,
+  )
+
+ def dirData(path):
+  data = []
   if path != '':
-   data.write(dirEntries(0, 0))
-  for p in tree.get(path, set()):
-   file = files.get(p, UnixFile(p, 0, 0, S_IFDIR | 0o775, 0, 0, None))
-   c, s = writeData(file.contents if not S_ISDIR(file.mode) else writeDir(file.path))
-   if S_ISDIR(file.mode):
-    dirs[file.path] = c
-
-   name, ext = (posixpath.basename(file.path).upper() + '.').split('.', 1)
-   name = name[:8].ljust(8, ' ').encode('ascii')
-   ext = ext[:3].ljust(3, ' ').encode('ascii')
+   data.append(dirEntry(b'.       ', b'   ', 0x10, 0, None, firstClusters[path], 0))
+   data.append(dirEntry(b'..      ', b'   ', 0x10, 0, None, firstClusters[posixpath.dirname(path).rstrip('/')], 0))
+  for p in sorted(tree.get(path, set())):
+   file = getFile(p)
+   name, ext, vfatNames = getNames(p)
    sum = 0
    for chr in (name + ext):
     sum = (((sum & 1) << 7) + (sum >> 1) + chr) & 0xff
 
-   fn = posixpath.basename(file.path) + '\0'
-   vfatEntries = [fn[o:o+13] for o in range(0, len(fn), 13)]
-   for i, n in list(enumerate(vfatEntries))[::-1]:
+   for i, n in list(enumerate(vfatNames))[::-1]:
     n = n.encode('utf-16le').ljust(26, b'\xff')
-    data.write(VfatDirEntry.pack(
-     sequence = i + 1 + (0x40 if i == len(vfatEntries)-1 else 0),
+    data.append(VfatDirEntry.pack(
+     sequence = i + 1 + (0x40 if i == len(vfatNames)-1 else 0),
      name1 = n[:10],
      attr = 0x0f,
      checksum = sum,
@@ -244,29 +255,61 @@ def writeFat(files, size, outFile):
      name3 = n[22:],
     ))
 
-   t = time.localtime(file.mtime)
-   data.write(FatDirEntry.pack(
-    name = name,
-    ext = ext,
-    attr = 0x10 if S_ISDIR(file.mode) else 0x04 if S_ISLNK(file.mode) else 0,
-    ctimeCs = 0x21 if S_ISLNK(file.mode) else 0,
-    time = (t.tm_hour << 11) + (t.tm_min << 5) + t.tm_sec // 2,
-    date = (max(t.tm_year - 1980, 0) << 9) + (t.tm_mon << 5) + t.tm_mday,
-    cluster = c,
-    size = s if not S_ISDIR(file.mode) else 0,
+   data.append(dirEntry(
+    name,
+    ext,
+    0x10 if S_ISDIR(file.mode) else 0x04 if S_ISLNK(file.mode) else 0,
+    0x21 if S_ISLNK(file.mode) else 0,
+    time.localtime(file.mtime),
+    firstClusters[p],
+    sizes[p] if not S_ISDIR(file.mode) else 0,
    ))
-  return data
+  return b''.join(data)
 
- root = writeDir('')
- root.seek(0)
- outFile.seek(rootOffset)
- shutil.copyfileobj(root, outFile)
+ # Start with an empty sparse image
+ outFile.seek(0)
+ outFile.truncate(0)
+ outFile.truncate(size)
 
- for p, c in dirs.items():
-  parent = posixpath.split(p)[0]
-  outFile.seek(dataOffset + (c - 2) * clusterSize)
-  outFile.write(dirEntries(dirs[parent] if parent != '/' else 0, c))
+ outFile.write(FatHeader.pack(
+  jump = b'\xeb\0\x90',
+  oemName = 8*b'\0',
+  bytesPerSector = sectorSize,
+  sectorsPerCluster = clusterSize // sectorSize,
+  reservedSectors = 1,
+  fatCopies = 1,
+  rootEntries = rootSize // FatDirEntry.size,
+  sectors = (dataOffset + dataClusters * clusterSize) // sectorSize,
+  mediaDescriptor = 0xf8,
+  sectorsPerFat = fatSectors,
+  extendedSignature = fatHeaderExtendedSignature,
+  serialNumber = 0,
+  volumeLabel = 11*b' ',
+  fsType = fsType,
+  signature = fatHeaderSignature,
+ ))
 
  outFile.seek(fatOffset)
- for i in range(0, len(clusters), 2):
-  outFile.write(dump32le(clusters[i] + ((clusters[i+1] << 12) if i+1 < len(clusters) else 0))[:3])
+ if bits == 12:
+  clusters.append(0)
+  outFile.write(b''.join(dump32le(clusters[i] | clusters[i+1] << 12)[:3] for i in range(0, len(clusters) - 1, 2)))
+ else:
+  outFile.write(b''.join(dump16le(c) for c in clusters))
+
+ outFile.seek(rootOffset)
+ outFile.write(dirData(''))
+
+ for path in dataPaths:
+  outFile.seek(dataOffset + (firstClusters[path] - 2) * clusterSize)
+  file = getFile(path)
+  if S_ISDIR(file.mode):
+   outFile.write(dirData(path))
+  else:
+   file.contents.seek(0)
+   shutil.copyfileobj(file.contents, outFile, 0x100000)
+
+ # Not every file can be extended by truncate()
+ outFile.seek(0, os.SEEK_END)
+ if outFile.tell() < size:
+  outFile.seek(size - 1)
+  outFile.write(b'\0')
@@ -2,7 +2,6 @@
 # Kernel source: arch/arm/include/asm/mach/warmboot.h
 # Kernel source: arch/arm/mach-cxd90014/include/mach/cmpr.h
 
-import io
 from stat import *
 
 from . import *
@@ -31,25 +30,23 @@ def isLzpt(file):
  header = LzptHeader.unpack(file)
  return header and header.magic == lzptHeaderMagic
 
-def readLzpt(file):
- """Decodes an LZTP image and returns its contents"""
+def readLzpt(file, workers=0):
+ """Decodes an LZTP image and returns its contents. If workers > 0, blocks are decompressed in parallel"""
  header = LzptHeader.unpack(file)
 
  if header.magic != lzptHeaderMagic:
   raise Exception('Wrong magic')
 
- tocEntries = [LzptTocEntry.unpack(file, header.tocOffset + offset) for offset in range(0, header.tocSize, LzptTocEntry.size)]
+ tocEntries = list(LzptTocEntry.iterUnpack(file, header.tocOffset, header.tocSize // LzptTocEntry.size))
 
- def generateChunks():
-  for entry in tocEntries:
-   file.seek(entry.offset)
-   block = io.BytesIO(file.read(entry.size))
+ def generateChunks(start=0):
+  def readBlocks():
+   for entry in tocEntries[start:]:
+    file.seek(entry.offset)
+    yield file.read(entry.size), 2 ** header.blockSize
 
-   read = 0
-   while read < 2 ** header.blockSize:
-    contents = lz77.inflateLz77(block)
-    yield contents
-    read += len(contents)
+  for contents in parallelMap(lz77.inflateLz77Blocks, readBlocks(), workers):
+   yield contents
 
  yield UnixFile(
   path = '',
@@ -58,5 +55,5 @@ def readLzpt(file):
   mode = S_IFREG,
   uid = 0,
   gid = 0,
-  contents = ChunkedFile(generateChunks),
+  contents = ChunkedFile(generateChunks, seekableChunks=True),
  )
@@ -1,8 +1,10 @@
 import io
 from stat import *
+import struct
 import zlib
 
 from . import *
+from ..io import *
 from ..util import *
 
 SquashfsSuper = Struct('SquashfsSuper', [
@@ -118,26 +120,56 @@ def readSquashfs(file):
  if super.compressionId != 1:
   raise Exception('Compression unsupported')
 
- def readMetadata(start, offset, size):
-  block = io.BytesIO()
-  file.seek(start)
-  while block.tell() < offset + size:
+ metadataCache = LruCache(256)
+
+ def readMetadataBlock(start):
+  """Returns the decompressed metadata block at start and the offset of the next block"""
+  block = metadataCache.get(start)
+  if block is None:
+   file.seek(start)
    header = parse16le(file.read(2))
    data = file.read(header & 0x7fff)
    if not (header & 0x8000):
     data = zlib.decompress(data)
-   block.write(data)
-  return block.getvalue()[offset:offset+size]
+   block = data, start + 2 + (header & 0x7fff)
+   metadataCache.put(start, block)
+  return block
+
+ def readMetadata(start, offset, size):
+  contents = []
+  while size > 0:
+   data, nextStart = readMetadataBlock(start)
+   if offset < len(data):
+    contents.append(data[offset:offset+size])
+    size -= len(contents[-1])
+   offset = max(offset - len(data), 0)
+   start = nextStart
+  return b''.join(contents)
 
  def readTable(start, count, size):
   entriesPerBlock = 0x2000 // size
   file.seek(start)
   blockOffsets = [parse64le(file.read(8)) for i in range((count + entriesPerBlock - 1) // entriesPerBlock)]
-  blocks = [readMetadata(o, 0, min(((count - i * entriesPerBlock) * size), 0x2000)) for i, o in enumerate(blockOffsets)]
-  return [block[i:i+size] for block in blocks for i in range(0, len(block), size)]
+  return b''.join(readMetadata(o, 0, min(((count - i * entriesPerBlock) * size), 0x2000)) for i, o in enumerate(blockOffsets))
+
+ fragments = list(SquashfsFragmentBlockEntry.iterUnpack(readTable(super.fragmentTableStart, super.fragmentEntryCount, SquashfsFragmentBlockEntry.size)))
+ ids = list(struct.unpack('<%dI' % super.idCount, readTable(super.idTableStart, super.idCount, 4)))
 
- fragments = [SquashfsFragmentBlockEntry.unpack(entry) for entry in readTable(super.fragmentTableStart, super.fragmentEntryCount, SquashfsFragmentBlockEntry.size)]
- ids = [parse32le(entry) for entry in readTable(super.idTableStart, super.idCount, 4)]
+ fragmentCache = LruCache(32)
+
+ def readDataBlock(start, size):
+  file.seek(start)
+  block = file.read(size & ~(1 << 24))
+  if not (size & (1 << 24)):
+   block = zlib.decompress(block)
+  return block
+
+ def readFragment(index):
+  block = fragmentCache.get(index)
+  if block is None:
+   block = readDataBlock(fragments[index].start, fragments[index].size)
+   fragmentCache.put(index, block)
+  return block
 
  def readInode(start, offset, path=''):
   start += super.inodeTableStart
@@ -176,26 +208,22 @@ def readSquashfs(file):
    blockSizes = readMetadata(start, offset + SquashfsInodeHeader.size + inodeStruct.size, blockCount * 4)
    blockSizes = [parse32le(blockSizes[i:i+4]) for i in range(0, len(blockSizes), 4)]
 
-   contents = io.BytesIO()
-   file.seek(f.blocksStart)
+   blockOffsets = [f.blocksStart]
    for blockSize in blockSizes:
-    s = min(f.fileSize - contents.tell(), super.blockSize)
-    if blockSize == 0:
-     contents.write(b'\0' * s)
-    else:
-     block = file.read(blockSize & ~(1 << 24))
-     if not (blockSize & (1 << 24)):
-      block = zlib.decompress(block)
-     contents.write(block.ljust(s, b'\0'))
-   if f.fragmentBlockIndex != 0xffffffff:
-    fragment = fragments[f.fragmentBlockIndex]
-    file.seek(fragment.start)
-    block = file.read(fragment.size & ~(1 << 24))
-    if not (fragment.size & (1 << 24)):
-     block = zlib.decompress(block)
-    contents.write(block[f.blockOffset:f.blockOffset+f.fileSize-contents.tell()])
-
-   contents.seek(0)
+    blockOffsets.append(blockOffsets[-1] + (blockSize & ~(1 << 24)))
+
+   def generateChunks(start=0, f=f, blockSizes=blockSizes, blockOffsets=blockOffsets):
+    for i in range(start, len(blockSizes)):
+     s = min(f.fileSize - i * super.blockSize, super.blockSize)
+     if blockSizes[i] == 0:
+      yield b'\0' * s
+     else:
+      yield readDataBlock(blockOffsets[i], blockSizes[i]).ljust(s, b'\0')
+    if f.fragmentBlockIndex != 0xffffffff:
+     read = len(blockSizes) * super.blockSize
+     yield readFragment(f.fragmentBlockIndex)[f.blockOffset:f.blockOffset+f.fileSize-read]
+
+   contents = ChunkedFile(generateChunks, f.fileSize, seekableChunks=True)
    yield UnixFile(
     path = path,
     size = f.fileSize,
@@ -1,7 +1,67 @@
+import binascii
+import bisect
+import io
+import mmap
 import os
 
+from ..util import LruCache
+
+def getBuffer(file):
+ """Returns a memoryview of the file's contents if it is backed by memory, None otherwise"""
+ return file.getBuffer() if hasattr(file, 'getBuffer') else None
+
+class MemoryFile(object):
+ """A read-only file backed by a buffer (e.g. an mmap). Reads are served from memory without any syscalls"""
+ def __init__(self, buffer):
+  self._buffer = memoryview(buffer)
+  self.pos = 0
+
+ def getBuffer(self):
+  return self._buffer
+
+ def seekable(self):
+  return True
+
+ def seek(self, pos, ref=os.SEEK_SET):
+  if ref == os.SEEK_SET:
+   self.pos = pos
+  elif ref == os.SEEK_CUR:
+   self.pos += pos
+  elif ref == os.SEEK_END:
+   self.pos = len(self._buffer) + pos
+  return self.pos
+
+ def tell(self):
+  return self.pos
+
+ def read(self, size=-1):
+  end = len(self._buffer) if size < 0 else self.pos + size
+  data = self._buffer[self.pos:end].tobytes()
+  self.pos += len(data)
+  return data
+
+def mapFile(file):
+ """Memory-maps a file opened for reading. Returns a MemoryFile, or the file itself if it cannot be mapped"""
+ try:
+  return MemoryFile(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+ except (AttributeError, EnvironmentError, OverflowError, ValueError, io.UnsupportedOperation):
+  return file
+
+class HashingFile(object):
+ """Wraps a file opened for writing and calculates the CRC32 of the data written to it"""
+ def __init__(self, file):
+  self.file = file
+  self.crc = 0
+  self.size = 0
+
+ def write(self, data):
+  self.crc = binascii.crc32(data, self.crc) & 0xffffffff
+  self.size += len(data)
+  return self.file.write(data)
+
 class FilePart(object):
- """A view of a part of a file. Can be used like a regular file"""
+ """A view of a part of a file. Can be used like a regular file.
+ If the underlying file is backed by memory, reads are served from a slice of its buffer"""
  def __init__(self, file, offset=0, size=-1):
   if size < 0:
    file.seek(0, os.SEEK_END)
@@ -10,6 +70,11 @@ class FilePart(object):
   self.offset = offset
   self.size = size
   self.pos = 0
+  buffer = getBuffer(file)
+  self._buffer = buffer[offset:offset+size] if buffer is not None else None
+
+ def getBuffer(self):
+  return self._buffer
 
  def seekable(self):
   return True
@@ -29,50 +94,111 @@ class FilePart(object):
  def read(self, size=-1):
   if size < 0:
    size = self.size
-  self.file.seek(self.offset + self.pos)
-  data = self.file.read(min(size, self.size - self.pos))
+  if self._buffer is not None:
+   data = self._buffer[self.pos:self.pos+max(size, 0)].tobytes()
+  else:
+   self.file.seek(self.offset + self.pos)
+   data = self.file.read(min(size, self.size - self.pos))
   self.pos += len(data)
   return data
 
+ def readinto(self, b):
+  size = max(min(len(b), self.size - self.pos), 0)
+  if self._buffer is not None:
+   b[:size] = self._buffer[self.pos:self.pos+size]
+  elif hasattr(self.file, 'readinto'):
+   self.file.seek(self.offset + self.pos)
+   size = self.file.readinto(memoryview(b)[:size])
+  else:
+   self.file.seek(self.offset + self.pos)
+   data = self.file.read(size)
+   size = len(data)
+   b[:size] = data
+  self.pos += size
+  return size
+
 
 class ChunkedFile(object):
- def __init__(self, generateChunks, size=-1):
+ """A file whose contents are produced in chunks by a generator function.
+ The offset of every generated chunk is recorded and recently used chunks are cached, so the file can be seeked freely.
+ If seekableChunks is set, generateChunks is called with the index of the first chunk it should produce.
+ Otherwise, it is restarted from the beginning when a chunk before the current one is needed."""
+ def __init__(self, generateChunks, size=-1, seekableChunks=False, cacheSize=16):
   self._generateChunks = generateChunks
   self._size = size
-  self.seek(0)
+  self._seekableChunks = seekableChunks
+  self._cache = LruCache(cacheSize)
+  self._offsets = [0]
+  self._complete = False
+  self._chunks = None
+  self._nextChunk = 0
+  self._pos = 0
+
+ def _getChunk(self, i):
+  """Returns chunk i, or None if there is no such chunk. i must not be greater than the number of known chunks"""
+  chunk = self._cache.get(i)
+  if chunk is not None:
+   return chunk
+  if self._complete and i >= len(self._offsets) - 1:
+   return None
+
+  # Seekable generators are restarted at chunk i instead of producing the chunks in between
+  if self._chunks is None or self._nextChunk > i or (self._seekableChunks and self._nextChunk < i):
+   self._nextChunk = i if self._seekableChunks else 0
+   self._chunks = self._generateChunks(i) if self._seekableChunks else self._generateChunks()
+
+  while self._nextChunk <= i:
+   try:
+    chunk = next(self._chunks)
+   except StopIteration:
+    self._chunks = None
+    self._complete = True
+    if self._size >= 0 and self._offsets[-1] < self._size:
+     raise Exception('Not enough bytes returned')
+    return None
+
+   if self._nextChunk == len(self._offsets) - 1:
+    self._offsets.append(self._offsets[-1] + len(chunk))
+    if self._size >= 0 and self._offsets[-1] > self._size:
+     raise Exception('Too many bytes returned')
+   self._cache.put(self._nextChunk, chunk)
+   self._nextChunk += 1
+  return chunk
+
+ def _getSize(self):
+  if self._size >= 0:
+   return self._size
+  while self._getChunk(len(self._offsets) - 1) is not None:
+   pass
+  return self._offsets[-1]
 
  def read(self, n=-1):
-  if self._chunks is None:
-   self._chunks = self._generateChunks()
-
-  try:
-   while n < 0 or len(self._buffer) < n:
-    self._buffer += next(self._chunks)
-  except StopIteration:
-   if self._size >= 0 and self._pos + len(self._buffer) < self._size:
-    raise Exception('Not enough bytes returned')
-  if self._size >= 0 and self._pos + len(self._buffer) > self._size:
-   raise Exception('Too many bytes returned')
-
-  contents = self._buffer if n < 0 else self._buffer[:n]
-  self._pos += len(contents)
-  self._buffer = self._buffer[len(contents):]
-  return contents
+  contents = []
+  while n != 0:
+   i = bisect.bisect_right(self._offsets, self._pos) - 1
+   chunk = self._getChunk(i)
+   if chunk is None:
+    break
+   start = self._pos - self._offsets[i]
+   data = chunk[start:] if n < 0 else chunk[start:start+n]
+   contents.append(data)
+   self._pos += len(data)
+   if n > 0:
+    n -= len(data)
+  return b''.join(contents)
 
  def seekable(self):
   return True
 
  def seek(self, pos, whence=os.SEEK_SET):
-  if whence == os.SEEK_SET and pos == 0:
-   self._chunks = None
-   self._pos = 0
-   self._buffer = b''
-  elif whence == os.SEEK_END and pos == 0 and self._size >= 0:
-   self._chunks = iter(())
-   self._pos = self._size
-   self._buffer = b''
-  else:
-   raise Exception('Seeking is not supported')
+  if whence == os.SEEK_CUR:
+   pos += self._pos
+  elif whence == os.SEEK_END:
+   pos += self._getSize()
+  if pos < 0:
+   raise Exception('Negative seek position')
+  self._pos = pos
+  return pos
 
  def tell(self):
   return self._pos
@@ -1,39 +1,73 @@
 """LZ77 decompressor"""
 # Kernel source: lib/lz77/lz77_inflate.c
 
-def inflateLz77(file):
- """Decodes LZ77 compressed data"""
- type = ord(file.read(1))
+_lengths = list(range(3, 17)) + [32, 64]
+
+def inflateLz77Into(data, out, offset=0):
+ """Decodes one LZ77 compressed stream from data (a bytes-like object, preferably a memoryview) starting at offset and appends the result to the bytearray out.
+ Returns the offset of the first byte after the stream. Raises IndexError if the stream does not end within data."""
+ type = data[offset]
+ offset += 1
 
  if type == 0x0f:
-  file.read(1)
-  data = file.read(2)
-  l = ord(data[0:1]) | ord(data[1:2]) << 8
-  return file.read(l)
+  l = data[offset+1] | data[offset+2] << 8
+  offset += 3
+  out += data[offset:offset+l]
+  return offset + l
  elif type == 0xf0:
-  out = b''
-  lengths = list(range(3, 17)) + [32, 64]
-
   while True:
-   flags = ord(file.read(1))
+   flags = data[offset]
+   offset += 1
 
    if flags == 0:
     # special case to improve performance
-    out += file.read(8)
+    out += data[offset:offset+8]
+    offset += 8
    else:
     for i in range(8):
      if (flags >> i) & 0x1:
-      data = file.read(2)
-      l = lengths[ord(data[0:1]) >> 4]
-      bd = (ord(data[0:1]) & 0xf) << 8 | ord(data[1:2])
+      l = _lengths[data[offset] >> 4]
+      bd = (data[offset] & 0xf) << 8 | data[offset+1]
+      offset += 2
 
       if bd == 0:
-       return out
+       return offset
 
-      d = out[-bd:]
-      d *= l // len(d) + 1
-      out += d[:l]
+      start = len(out) - bd
+      if bd >= l:
+       out += out[start:start+l]
+      else:
+       # overlapping copy: repeat the last bd bytes
+       d = out[start:]
+       out += (d * (l // bd + 1))[:l]
      else:
-      out += file.read(1)
+      out.append(data[offset])
+      offset += 1
  else:
   raise Exception('Unknown type')
+
+def inflateLz77Blocks(data, size):
+ """Decodes consecutive LZ77 compressed streams from data until at least size bytes have been produced. Returns a bytearray"""
+ data = memoryview(data)
+ out = bytearray()
+ offset = 0
+ while len(out) < size:
+  offset = inflateLz77Into(data, out, offset)
+ return out
+
+def inflateLz77(file, bufferSize=0x10000):
+ """Decodes one LZ77 compressed stream from a file. The file is read in growing steps until it contains the whole stream"""
+ start = file.tell()
+ data = b''
+ while True:
+  more = file.read(max(len(data), bufferSize))
+  data += more
+  out = bytearray()
+  try:
+   end = inflateLz77Into(memoryview(data), out)
+   break
+  except IndexError:
+   if not more:
+    raise Exception('Unexpected end of data')
+ file.seek(start + end)
+ return bytes(out)
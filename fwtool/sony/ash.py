@@ -1,7 +1,9 @@
 from collections import namedtuple
 import io
+import os
 
 from .xor55 import *
+from ..io import *
 from ..util import *
 
 AshFile = namedtuple('AshFile', 'model, region, version, firmware')
@@ -18,16 +20,23 @@ AshHeader = Struct('AshHeader', [
 ], Struct.BIG_ENDIAN)
 ashHeaderMagic = b'CX0900AP'
 
-def _decryptLut(data):
- lut = bytes(b * b * b % 253 if b < 253 else b for b in range(256))
- return b''.join(lut[b:b+1] for b in data)
+_lut = bytes(bytearray(b * b * b % 253 if b < 253 else b for b in range(256)))
 
-def _decryptXor(data):
- return cryptXor55(0x12345678, data)
+def _decryptLut(file, chunkSize=0x100000):
+ file.seek(0, os.SEEK_END)
+ size = file.tell()
+ def generateChunks(start=0):
+  for offset in range(start * chunkSize, size, chunkSize):
+   file.seek(offset)
+   yield file.read(chunkSize).translate(_lut)
+ return ChunkedFile(generateChunks, size, seekableChunks=True)
+
+def _decryptXor(file):
+ return cryptXor55File(0x12345678, file)
 
 def _findDecryptFunc(file):
  file.seek(0)
- data = file.read(AshHeader.size)
+ data = io.BytesIO(file.read(AshHeader.size))
  for f in [_decryptLut, _decryptXor]:
   header = AshHeader.unpack(f(data))
   if header and header.magic == ashHeaderMagic:
@@ -37,17 +46,19 @@ def isAsh(file):
  return _findDecryptFunc(file) is not None
 
 def readAsh(file):
+ """Reads an ASH firmware image. The firmware data is decrypted while it is read"""
  decrypt = _findDecryptFunc(file)
  if decrypt is None:
   raise Exception('Cannot decrypt')
 
- file.seek(0)
- data = decrypt(file.read())
+ data = decrypt(file)
  header = AshHeader.unpack(data)
 
  if header.magic != ashHeaderMagic:
   raise Exception('Wrong magic')
- if (sum(data[AshHeader.size:]) & 0xffffffff) != header.checksum:
+ data.seek(AshHeader.size)
+ if sum32(data) != header.checksum:
   raise Exception('Wrong checksum')
 
- return AshFile(int(header.model), int(header.region, 16), '%d.00' % header.version, io.BytesIO(data))
+ data.seek(0)
+ return AshFile(int(header.model), int(header.region, 16), '%d.00' % header.version, data)
@@ -1,11 +1,12 @@
 """Parser for the .dat file contained in the updater executable"""
 
+import binascii
 from collections import namedtuple
 import io
 import re
 import shutil
 
-from ..io import FilePart
+from ..io import FilePart, HashingFile
 from ..util import *
 
 DatFile = namedtuple('DatFile', 'normalUsbDescriptors, updaterUsbDescriptors, isLens, firmwareData')
@@ -83,26 +84,28 @@ def readChunks(file):
  return chunks, offset
 
 def writeChunks(chunks, file):
+ """Writes a .dat file containing the chunks. Returns the end offset and the CRC32 of the written data"""
+ header = DatHeader.pack(magic=datHeaderMagic)
  file.seek(0)
- file.write(DatHeader.pack(magic=datHeaderMagic))
- offset = DatHeader.size
+ file.write(header)
+ offset = len(header)
+ crc = binascii.crc32(header) & 0xffffffff
 
  for type, contents in chunks:
-  file.seek(offset)
-  file.write(b'\0' * DatChunkHeader.size)
+  file.seek(offset + DatChunkHeader.size)
   contents.seek(0)
-  shutil.copyfileobj(contents, file)
+  hashingFile = HashingFile(file)
+  shutil.copyfileobj(contents, hashingFile)
+  chunkHeader = DatChunkHeader.pack(type=type, size=hashingFile.size)
   file.seek(offset)
-  file.write(DatChunkHeader.pack(type=type, size=contents.tell()))
-  offset += DatChunkHeader.size + contents.tell()
-
- return offset
+  file.write(chunkHeader)
+  crc = crc32Combine(binascii.crc32(chunkHeader, crc) & 0xffffffff, hashingFile.crc, hashingFile.size)
+  offset += len(chunkHeader) + hashingFile.size
 
-def _calcCrc(file, fileSize):
- return crc32(FilePart(file, 0, fileSize - DatChunkHeader.size - DendChunk.size))
+ return offset, crc
 
 def readDat(file):
- """Reads a .dat file"""
+ """Reads a .dat file. The checksum is verified before it is returned, so the firmware data can be used right away"""
  chunkList, fileSize = readChunks(file)
  chunks = dict(chunkList)
 
@@ -115,12 +118,12 @@ def readDat(file):
   raise Exception('Wrong protocol version')
 
  descriptors = {descriptorTypeNormal: [], descriptorTypeUpdater: []}
- for i in range(UdidChunkHeader.unpack(chunks[udidChunkType]).descriptorCount):
-  descriptor = UdidChunkDescriptor.unpack(chunks[udidChunkType], UdidChunkHeader.size + i * UdidChunkDescriptor.size)
+ for descriptor in UdidChunkDescriptor.iterUnpack(chunks[udidChunkType], UdidChunkHeader.size, UdidChunkHeader.unpack(chunks[udidChunkType]).descriptorCount):
   descriptors[descriptor.mode].append((descriptor.vid, descriptor.pid))
 
+ # The checksum covers everything before the DEND chunk
  dend = DendChunk.unpack(chunks[dendChunkType])
- if _calcCrc(file, fileSize) != dend.crc:
+ if crc32(FilePart(file, 0, fileSize - DatChunkHeader.size - DendChunk.size)) != dend.crc:
   raise Exception('Wrong checksum')
 
  return DatFile(
@@ -138,14 +141,12 @@ def writeDat(dat, file):
   for vid, pid in descs:
    udidChunk.write(UdidChunkDescriptor.pack(vid=vid, pid=pid, mode=type))
 
- fileSize = writeChunks([
+ offset, crc = writeChunks([
   (datvChunkType, io.BytesIO(DatvChunk.pack(dataVersion=datvDataVersion, isLens=dat.isLens))),
   (provChunkType, io.BytesIO(ProvChunk.pack(protocolVersion=provProtocolVersion))),
   (udidChunkType, udidChunk),
   (fdatChunkType, dat.firmwareData),
-  (dendChunkType, io.BytesIO(b'\0' * DendChunk.size)),
  ], file)
 
- crc = _calcCrc(file, fileSize)
- file.seek(fileSize - DendChunk.size)
- file.write(DendChunk.pack(crc=crc))
+ file.seek(offset)
+ file.write(DatChunkHeader.pack(type=dendChunkType, size=DendChunk.size) + DendChunk.pack(crc=crc))
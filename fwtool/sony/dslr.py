@@ -26,18 +26,18 @@ DslrFileHeader = Struct('DslrFileHeader', [
  ('...', 12),
 ])
 
-def _decrypt(data, little):
- return cryptXor55(0x87654321, data, little)
+def _decrypt(file, little):
+ return cryptXor55File(0x87654321, file, little)
 
-def _decryptBigEndian(data):
- return _decrypt(data, False)
+def _decryptBigEndian(file):
+ return _decrypt(file, False)
 
-def _decryptLittleEndian(data):
- return _decrypt(data, True)
+def _decryptLittleEndian(file):
+ return _decrypt(file, True)
 
 def _findDecryptFunc(file):
  file.seek(0)
- data = file.read(DslrFirmwareHeader.size)
+ data = io.BytesIO(file.read(DslrFirmwareHeader.size))
  for f in [_decryptBigEndian, _decryptLittleEndian]:
   header = DslrFirmwareHeader.unpack(f(data))
   if header and header.magic == dslrFirmwareHeaderMagic:
@@ -47,12 +47,12 @@ def isDslrFirmware(file):
  return _findDecryptFunc(file) is not None
 
 def decryptDslrFirmware(file):
+ """Decrypts a DSLR firmware image. The data is decrypted while it is read"""
  decrypt = _findDecryptFunc(file)
  if decrypt is None:
   raise Exception('Cannot decrypt')
 
- file.seek(0)
- return io.BytesIO(decrypt(file.read()))
+ return decrypt(file)
 
 def readDslrFirmware(file):
  header = DslrFirmwareHeader.unpack(file)
@@ -61,7 +61,7 @@ def readDslrFirmware(file):
   raise Exception('Wrong magic')
 
  file.seek(DslrFirmwareHeader.size + header.nFiles * DslrFileHeader.size)
- if (sum(file.read()) & 0xffffffff) != header.checksum:
+ if sum32(file) != header.checksum:
   raise Exception('Wrong checksum')
 
  if header.version.isdigit():
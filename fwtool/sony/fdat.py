@@ -1,20 +1,19 @@
 """Decrypter & parser for FDAT firmware images"""
 
+import binascii
 from collections import namedtuple, OrderedDict
-import io
+import os
 import re
 import shutil
+import struct
 
 try:
  from Cryptodome.Cipher import AES
- from Cryptodome.Hash import SHA
- from Cryptodome.Util.strxor import strxor
 except ImportError:
  from Crypto.Cipher import AES
- from Crypto.Hash import SHA
- from Crypto.Util.strxor import strxor
 
 from . import constants
+from .shaxor import *
 from ..io import *
 from ..util import *
 
@@ -73,6 +72,12 @@ class BlockCryptException(Exception):
 
 
 class Crypter(object):
+ batchBlocks = 1024
+ # Set if encrypted batches only depend on their plaintext, so that unchanged ones can be reused by reencrypt()
+ independentBatches = False
+ # Set if encrypted images have to be signed. encrypt() cannot create the signature
+ signed = False
+
  def __init__(self, decryptBlockSize, encryptBlockSize):
   self._decryptBlockSize = decryptBlockSize
   self._encryptBlockSize = encryptBlockSize
@@ -89,24 +94,67 @@ class Crypter(object):
  def encryptBlock(self, data):
   return data
 
- def _crypt(self, file, blockSize, cryptFunc):
+ def _forEachBlock(self, data, blockSize, func):
+  """Calls func for every block in a batch, setting isFirstBlock and isLastBlock"""
+  out = []
+  for offset in range(0, len(data), blockSize):
+   self.isFirstBlock = self.isFirstBatch and offset == 0
+   self.isLastBlock = self.isLastBatch and offset + blockSize >= len(data)
+   out.append(func(data[offset:offset+blockSize]))
+  return b''.join(out)
+
+ def unpackBatch(self, data):
+  return self._forEachBlock(data, self._decryptBlockSize, self.unpackBlock)
+
+ def packBatch(self, data):
+  return self._forEachBlock(data, self._encryptBlockSize, self.packBlock)
+
+ def decryptBatch(self, data):
+  return self._forEachBlock(data, self._decryptBlockSize, self.decryptBlock)
+
+ def encryptBatch(self, data):
+  return self._forEachBlock(data, self._decryptBlockSize, self.encryptBlock)
+
+ def _crypt(self, file, blockSize, cryptFunc, batchBlocks, firstBatchBlocks=None):
+  """Reads batchBlocks blocks at a time (firstBatchBlocks for the first batch) and passes them to cryptFunc with their offset"""
   def generateChunks():
-   file.seek(0)
-   self.isFirstBlock = True
-   nextData = file.read(blockSize)
+   self.isFirstBatch = True
+   offset = 0
+   file.seek(offset)
+   nextData = file.read(blockSize * (firstBatchBlocks or batchBlocks))
    while nextData != b'':
     data = nextData
-    nextData = file.read(blockSize)
-    self.isLastBlock = (nextData == b'')
-    yield cryptFunc(data)
-    self.isFirstBlock = False
+    offset += len(data)
+    file.seek(offset)
+    nextData = file.read(blockSize * batchBlocks)
+    self.isLastBatch = (nextData == b'')
+    yield cryptFunc(data, offset - len(data))
+    self.isFirstBatch = False
   return ChunkedFile(generateChunks)
 
- def decrypt(self, file):
-  return self._crypt(file, self._decryptBlockSize, lambda data: self.unpackBlock(self.decryptBlock(data)))
+ def decrypt(self, file, batchBlocks=None, firstBatchBlocks=None):
+  return self._crypt(file, self._decryptBlockSize, lambda data, offset: self.unpackBatch(self.decryptBatch(data)), batchBlocks or self.batchBlocks, firstBatchBlocks)
 
- def encrypt(self, file):
-  return self._crypt(file, self._encryptBlockSize, lambda data: self.encryptBlock(self.packBlock(data)))
+ def encrypt(self, file, batchBlocks=None):
+  return self._crypt(file, self._encryptBlockSize, lambda data, offset: self.encryptBatch(self.packBatch(data)), batchBlocks or self.batchBlocks)
+
+ def reencrypt(self, file, oldFile, oldEncrypted, batchBlocks=None):
+  """Encrypts file like encrypt(). Batches with the same plaintext as in oldFile are copied from oldEncrypted, the encrypted version of oldFile"""
+  if not self.independentBatches:
+   return self.encrypt(file, batchBlocks)
+  batchBlocks = batchBlocks or self.batchBlocks
+  oldFile.seek(0, os.SEEK_END)
+  oldSize = oldFile.tell()
+
+  def cryptFunc(data, offset):
+   # The last block is flagged, so only batches which are followed by more data in both files can be reused
+   if not self.isLastBatch and offset + len(data) < oldSize:
+    oldFile.seek(offset)
+    if oldFile.read(len(data)) == data:
+     oldEncrypted.seek(offset // self._encryptBlockSize * self._decryptBlockSize)
+     return oldEncrypted.read(batchBlocks * self._decryptBlockSize)
+   return self.encryptBatch(self.packBatch(data))
+  return self._crypt(file, self._encryptBlockSize, cryptFunc, batchBlocks)
 
 
 class BlockCrypter(Crypter):
@@ -134,6 +182,69 @@ class BlockCrypter(Crypter):
   data = dump16le(sizeAndEndFlag) + data + b'\xff' * (self._decryptBlockSize - 4 - len(data))
   return dump16le(self._calcSum(data)) + data
 
+ def _readWords(self, data, offset):
+  """Returns the 16 bit word at offset of every block in data"""
+  words = bytearray(2 * (len(data) // self._decryptBlockSize))
+  words[0::2] = data[offset::self._decryptBlockSize]
+  words[1::2] = data[offset+1::self._decryptBlockSize]
+  return struct.unpack('<%dH' % (len(words) // 2), bytes(words))
+
+ def _writeWords(self, data, offset, values):
+  """Sets the 16 bit word at offset of every block in data"""
+  words = struct.pack('<%dH' % len(values), *values)
+  data[offset::self._decryptBlockSize] = words[0::2]
+  data[offset+1::self._decryptBlockSize] = words[1::2]
+
+ def _calcSums(self, data):
+  """Calculates the checksums of all blocks in data at once"""
+  # Add up the words at the same position in every block as one integer with 32 bit lanes per block
+  count = len(data) // self._decryptBlockSize
+  lanes = bytearray(4 * count)
+  total = 0
+  for offset in range(2, self._decryptBlockSize, 2):
+   lanes[0::4] = data[offset::self._decryptBlockSize]
+   lanes[1::4] = data[offset+1::self._decryptBlockSize]
+   total += int.from_bytes(lanes, 'little')
+  return tuple(sum & 0xffff for sum in struct.unpack('<%dI' % count, total.to_bytes(4 * count, 'little')))
+
+ def unpackBatch(self, data):
+  blockSize = self._decryptBlockSize
+  if len(data) % blockSize:
+   return super(BlockCrypter, self).unpackBatch(data)
+  count = len(data) // blockSize
+
+  if self._calcSums(data) != self._readWords(data, 0):
+   raise BlockCryptException('Wrong checksum')
+
+  out = bytearray(count * (blockSize - 4))
+  view = memoryview(data)
+  size = 0
+  for i, sizeAndEndFlag in enumerate(self._readWords(data, 2)):
+   endFlag = (sizeAndEndFlag & 0x8000) != 0
+   if endFlag != (self.isLastBatch and i == count - 1):
+    raise BlockCryptException('Wrong last block flag')
+   l = min(sizeAndEndFlag & 0x7fff, blockSize - 4)
+   out[size:size+l] = view[i*blockSize+4:i*blockSize+4+l]
+   size += l
+  del out[size:]
+  return bytes(out)
+
+ def packBatch(self, data):
+  blockSize = self._decryptBlockSize
+  payloadSize = self._encryptBlockSize
+  count = (len(data) + payloadSize - 1) // payloadSize
+
+  out = bytearray(b'\xff' * (count * blockSize))
+  view = memoryview(data)
+  sizeAndEndFlags = []
+  for i in range(count):
+   payload = view[i*payloadSize:(i+1)*payloadSize]
+   out[i*blockSize+4:i*blockSize+4+len(payload)] = payload
+   sizeAndEndFlags.append(len(payload) | (0x8000 if self.isLastBatch and i == count - 1 else 0))
+  self._writeWords(out, 2, sizeAndEndFlags)
+  self._writeWords(out, 0, self._calcSums(out))
+  return bytes(out)
+
 
 class ShaCrypter(BlockCrypter):
  """Decrypts a block from a 1st gen firmware image using sha1 digests"""
@@ -141,21 +252,20 @@ class ShaCrypter(BlockCrypter):
   super(ShaCrypter, self).__init__(1000)
   self._key = key
 
- def decryptBlock(self, data):
-  if self.isFirstBlock:
-   self._digest = self._key[:20]
-  xorKey = io.BytesIO()
-  while xorKey.tell() < len(data):
-   self._digest = SHA.new(self._digest + self._key[20:40]).digest()
-   xorKey.write(self._digest)
-  return strxor(data, xorKey.getvalue())
+ def decryptBatch(self, data):
+  if self.isFirstBatch:
+   self._keystream = ShaKeystream(self._key)
+  # Blocks are multiples of the digest size, so the keystream continues across them
+  return self._keystream.crypt(data)
 
- def encryptBlock(self, data):
-  return self.decryptBlock(data)
+ def encryptBatch(self, data):
+  return self.decryptBatch(data)
 
 
 class AesCrypter(BlockCrypter):
  """Decrypts a block from a 2nd gen firmware image using AES"""
+ independentBatches = True
+
  def __init__(self, key):
   super(AesCrypter, self).__init__(1024)
   self._cipher = AES.new(key, AES.MODE_ECB)
@@ -166,6 +276,10 @@ class AesCrypter(BlockCrypter):
  def encryptBlock(self, data):
   return self._cipher.encrypt(data)
 
+ # ECB blocks are independent, so a whole batch can be crypted at once
+ decryptBatch = decryptBlock
+ encryptBatch = encryptBlock
+
 
 class DoubleAesCrypter(AesCrypter):
  """Decrypts a block from a 3rd gen firmware image using AES"""
@@ -174,7 +288,7 @@ class DoubleAesCrypter(AesCrypter):
   self._cipher2 = AES.new(key2, AES.MODE_ECB)
 
  def decryptBlock(self, data):
-  decrypted = super(DoubleAesCrypter, self).decryptBlock(data)
+  decrypted = self._cipher.decrypt(data)
   doubleDecrypted = self._cipher2.decrypt(decrypted)
   if self.isFirstBlock:
    return decrypted[:512] + doubleDecrypted[512:]
@@ -185,11 +299,22 @@ class DoubleAesCrypter(AesCrypter):
   encrypted = self._cipher2.encrypt(data)
   if self.isFirstBlock:
    encrypted = data[:512] + encrypted[512:]
-  return super(DoubleAesCrypter, self).encryptBlock(encrypted)
+  return self._cipher.encrypt(encrypted)
+
+ def decryptBatch(self, data):
+  self.isFirstBlock = self.isFirstBatch
+  return self.decryptBlock(data)
+
+ def encryptBatch(self, data):
+  self.isFirstBlock = self.isFirstBatch
+  return self.encryptBlock(data)
 
 
 class AesCbcCrypter(AesCrypter):
  """Decrypts a block from a 4th gen firmware image using AES CBC"""
+ independentBatches = False
+ signed = True
+
  def __init__(self, key1, key2):
   super(AesCbcCrypter, self).__init__(key1)
   self._key = key2
@@ -197,19 +322,39 @@ class AesCbcCrypter(AesCrypter):
  def decryptBlock(self, data):
   if self.isFirstBlock:
    self._cipher2 = AES.new(self._key, AES.MODE_CBC, self._iv)
-   return super(AesCbcCrypter, self).decryptBlock(data[:512]) + self._cipher2.decrypt(data[512:])
+   return self._cipher.decrypt(data[:512]) + self._cipher2.decrypt(data[512:])
   else:
    return self._cipher2.decrypt(data)
 
- def decrypt(self, file):
+ def encryptBlock(self, data):
+  if self.isFirstBlock:
+   self._cipher2 = AES.new(self._key, AES.MODE_CBC, self._iv)
+   return self._cipher.encrypt(data[:512]) + self._cipher2.encrypt(data[512:])
+  else:
+   return self._cipher2.encrypt(data)
+
+ def decryptBatch(self, data):
+  self.isFirstBlock = self.isFirstBatch
+  return self.decryptBlock(data)
+
+ def encryptBatch(self, data):
+  self.isFirstBlock = self.isFirstBatch
+  data = self.encryptBlock(data)
+  if self.isLastBatch:
+   # The footer contains the IV and the 0x100 byte signature, which is left empty
+   data += self._iv + b'\0' * 0x100
+  return data
+
+ def decrypt(self, file, batchBlocks=None, firstBatchBlocks=None):
   file.seek(-0x110, 2)
   size = file.tell()
   self._iv = file.read(0x10)
   file = FilePart(file, 0, size)
-  return super(AesCbcCrypter, self).decrypt(file)
+  return super(AesCbcCrypter, self).decrypt(file, batchBlocks, firstBatchBlocks)
 
- def encrypt(self, file):
-  raise Exception('Encryption not supported')
+ def encrypt(self, file, batchBlocks=None):
+  self._iv = os.urandom(0x10)
+  return super(AesCbcCrypter, self).encrypt(file, batchBlocks)
 
 
 _crypters = OrderedDict([
@@ -235,31 +380,58 @@ def isFdat(file):
  return header and header.magic == fdatHeaderMagic and header.fileSystemHeaders.endswith(4*b'\0')
 
 
+def _probeCrypter(crypterName, file):
+ """Decrypts file, checking the checksum and the FDAT header of the first block before anything else is decrypted"""
+ # The first block is a batch of its own, so a wrong crypter fails after one block
+ fdatFile = _crypters[crypterName]().decrypt(file, firstBatchBlocks=1)
+ try:
+  if isFdat(fdatFile):
+   fdatFile.seek(0)
+   return fdatFile
+ except BlockCryptException:
+  pass
+ return None
+
+
+def isSignedCrypter(crypterName):
+ """Returns true if images encrypted with this crypter have to be signed"""
+ return _crypters[crypterName]().signed
+
+
 def decryptFdat(file):
  """Decrypts an encrypted FDAT file"""
- for crypterName, crypter in _crypters.items():
-  try:
-   fdatFile = crypter().decrypt(file)
-   if isFdat(fdatFile):
-    fdatFile.seek(0)
-    return crypterName, fdatFile
-  except BlockCryptException:
-   pass
+ for crypterName in _crypters:
+  fdatFile = _probeCrypter(crypterName, file)
+  if fdatFile:
+   return crypterName, fdatFile
  raise Exception('No decrypter found')
 
 
-def encryptFdat(file, crypterName):
- """Encrypts a FDAT file"""
- return _crypters[crypterName]().encrypt(file)
+def encryptFdat(file, crypterName, oldFile=None, oldEncrypted=None):
+ """Encrypts a FDAT file. If a previous version of the file and its encrypted data are given, unchanged parts are reused if possible"""
+ crypter = _crypters[crypterName]()
+ if not oldFile:
+  return crypter.encrypt(file)
 
+ # Encrypted data can only be reused if it has been encrypted with the same crypter and belongs to oldFile
+ oldDecrypted = _probeCrypter(crypterName, oldEncrypted)
+ if not oldDecrypted:
+  raise Exception('The previous image has not been encrypted with %s' % crypterName)
+ oldFile.seek(0)
+ if oldDecrypted.read(FdatHeader.size) != oldFile.read(FdatHeader.size):
+  raise Exception('The previous image does not match its encrypted version')
+ return crypter.reencrypt(file, oldFile, oldEncrypted)
 
-def _calcCrc(file):
- return crc32(FilePart(file, 12, FdatHeader.size - 12))
+
+def _calcCrc(header):
+ return binascii.crc32(header[12:]) & 0xffffffff
 
 
 def readFdat(file):
  """Reads a decrypted FDAT file and returns its contents"""
- header = FdatHeader.unpack(file)
+ file.seek(0)
+ headerData = file.read(FdatHeader.size)
+ header = FdatHeader.unpack(headerData)
 
  if header.magic != fdatHeaderMagic:
   raise Exception('Wrong magic')
@@ -267,7 +439,7 @@ def readFdat(file):
  if header.version != fdatVersion:
   raise Exception('Wrong version')
 
- if _calcCrc(file) != header.checksum:
+ if _calcCrc(headerData) != header.checksum:
   raise Exception('Wrong checksum')
 
  if header.modeType != updateModeUser:
@@ -277,8 +449,7 @@ def readFdat(file):
   raise Exception('Unsupported LUW flag')
 
  fileSystem = None
- for i in range(0, len(header.fileSystemHeaders), FdatFileSystemHeader.size):
-  fs = FdatFileSystemHeader.unpack(header.fileSystemHeaders, i)
+ for fs in FdatFileSystemHeader.iterUnpack(header.fileSystemHeaders):
   if fs.modeType == fsModeTypeUser:
    fileSystem = fs
    break
@@ -295,20 +466,8 @@ def readFdat(file):
  )
 
 
-def writeFdat(fdat, outFile):
- """Writes a non-encrypted FDAT file"""
- outFile.seek(0)
- outFile.write(b'\0' * FdatHeader.size)
- fsOffset = FdatHeader.size
-
- fdat.fs.seek(0)
- shutil.copyfileobj(fdat.fs, outFile)
- firmwareOffset = outFile.tell()
-
- fdat.firmware.seek(0)
- shutil.copyfileobj(fdat.firmware, outFile)
- endOffset = outFile.tell()
-
+def packFdat(fdat):
+ """Returns a non-encrypted FDAT file. Its contents are generated while it is read"""
  version = re.match('^(\d)\.(\d{2})$', fdat.version)
  if not version:
   raise Exception('Cannot parse version string')
@@ -316,10 +475,17 @@ def writeFdat(fdat, outFile):
  if modelIsAccessory(fdat.model) != fdat.isAccessory:
   raise Exception('Wrong accessory flag')
 
- outFile.seek(0)
- outFile.write(FdatHeader.pack(
+ fdat.fs.seek(0, os.SEEK_END)
+ fsSize = fdat.fs.tell()
+ fdat.firmware.seek(0, os.SEEK_END)
+ firmwareSize = fdat.firmware.tell()
+
+ fsOffset = FdatHeader.size
+ firmwareOffset = fsOffset + fsSize
+ endOffset = firmwareOffset + firmwareSize
+
+ header = dict(
   magic = fdatHeaderMagic,
-  checksum = 0,
   version = fdatVersion,
   modeType = updateModeUser,
   luwFlag = luwFlagNormal,
@@ -328,13 +494,25 @@ def writeFdat(fdat, outFile):
   model = fdat.model,
   region = fdat.region,
   firmwareOffset = firmwareOffset,
-  firmwareSize = endOffset - firmwareOffset,
+  firmwareSize = firmwareSize,
   numFileSystems = 2,
-  fileSystemHeaders = FdatFileSystemHeader.pack(modeType=fsModeTypeUser, offset=fsOffset, size=firmwareOffset-fsOffset)
+  fileSystemHeaders = FdatFileSystemHeader.pack(modeType=fsModeTypeUser, offset=fsOffset, size=fsSize)
                     + FdatFileSystemHeader.pack(modeType=fsModeTypeProd, offset=fsOffset, size=0)
                     + b'\0' * ((maxNumFileSystems-2) * FdatFileSystemHeader.size),
- ))
+ )
+ headerData = FdatHeader.pack(checksum=_calcCrc(FdatHeader.pack(checksum=0, **header)), **header)
 
- crc = _calcCrc(outFile)
- outFile.seek(8)
- outFile.write(dump32le(crc))
+ def generateChunks():
+  yield headerData
+  for file in [fdat.fs, fdat.firmware]:
+   file.seek(0)
+   for chunk in iter(lambda: file.read(0x100000), b''):
+    yield chunk
+ # The file is usually read once from start to end, so few chunks have to be cached
+ return ChunkedFile(generateChunks, endOffset, cacheSize=2)
+
+
+def writeFdat(fdat, outFile):
+ """Writes a non-encrypted FDAT file"""
+ outFile.seek(0)
+ shutil.copyfileobj(packFdat(fdat), outFile)
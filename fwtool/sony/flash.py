@@ -34,8 +34,7 @@ def readPartitionTable(file):
  if header.version != sdmPartitionTableHeaderVersion:
   raise Exception('Wrong version')
 
- for i in range(header.nPartition):
-  partition = SdmPartition.unpack(file, SdmPartitionTableHeader.size + i*SdmPartition.size)
+ for i, partition in enumerate(SdmPartition.iterUnpack(file, SdmPartitionTableHeader.size, header.nPartition)):
   if partition.flag & 1:
    yield i+1, FilePart(file, partition.start, partition.size)
 
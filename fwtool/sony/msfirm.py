@@ -14,6 +14,7 @@ except ImportError:
  from Crypto.Util.strxor import strxor
 
 from . import constants
+from .shaxor import *
 from .. import archive
 from ..io import *
 
@@ -34,12 +35,7 @@ class MsCrypter(object):
   return self._calcHash(header[:-20] + b'\0' * 20) == header[-20:]
 
  def _cipher(self, data):
-  xorKey = io.BytesIO()
-  digest = self.key[:20]
-  while xorKey.tell() < len(data):
-   digest = SHA.new(digest + self.key[20:40]).digest()
-   xorKey.write(digest)
-  return strxor(data, xorKey.getvalue()[:len(data)])
+  return ShaKeystream(self.key).crypt(data)
 
  def _decrypt(self, file, off, size):
   file.seek(off)
@@ -0,0 +1,31 @@
+import hashlib
+
+try:
+ from Cryptodome.Util.strxor import strxor
+except ImportError:
+ from Crypto.Util.strxor import strxor
+
+class ShaKeystream(object):
+ """The keystream of the sha1 based ciphers: Every digest is the sha1 of the previous digest and key[20:40]"""
+ def __init__(self, key):
+  self._digest = key[:20]
+  self._salt = key[20:40]
+  self._buffer = b''
+
+ def read(self, size):
+  """Returns the next size bytes of the keystream"""
+  sha1 = hashlib.sha1
+  digest = self._digest
+  salt = self._salt
+  digests = [self._buffer]
+  for i in range((size - len(self._buffer) + 19) // 20):
+   digest = sha1(digest + salt).digest()
+   digests.append(digest)
+  self._digest = digest
+  data = b''.join(digests)
+  self._buffer = data[size:]
+  return data[:size]
+
+ def crypt(self, data):
+  """Xors data with the next len(data) bytes of the keystream"""
+  return strxor(data, self.read(len(data))) if data else b''
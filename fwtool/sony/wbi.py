@@ -1,7 +1,6 @@
 """Parser for warm boot images"""
 
 from collections import namedtuple
-import io
 
 from .. import lz77
 from ..io import *
@@ -41,7 +40,9 @@ def isWbi(file):
  header = WbiHeader.unpack(file)
  return header and header.magic == wbiHeaderMagic
 
-def readWbi(file):
+def readWbi(file, workers=0):
+ """Reads a warm boot image and returns its sections. If workers > 0, the sections are decompressed in parallel and yielded in section order.
+ The checksum and metaChecksum fields of the sections are not verified."""
  header = WbiHeader.unpack(file)
 
  if header.magic != wbiHeaderMagic:
@@ -62,18 +63,34 @@ def readWbi(file):
    break
   wbiHeaderSize += header.sectorSize
 
+ sections = []
  offset = 0
- for i in range(header.numSections):
-  section = WbiSectionHeader.unpack(file, wbiHeaderSize + header.dataSize + i * WbiSectionHeader.size)
+ for section in WbiSectionHeader.iterUnpack(file, wbiHeaderSize + header.dataSize, header.numSections):
+  sections.append((wbiHeaderSize + offset, section))
+  offset += section.size
 
-  def generateChunks(offset=offset, section=section):
-   file.seek(wbiHeaderSize + offset)
-   block = io.BytesIO(file.read(section.size))
-   read = 0
-   while read < section.osize:
-    contents = lz77.inflateLz77(block)
-    yield contents
-    read += len(contents)
+ if workers > 0:
+  def readSections():
+   for offset, section in sections:
+    file.seek(offset)
+    yield file.read(section.size), section.osize
 
-  yield WbiChunk(section.addr, section.virt, section.osize, ChunkedFile(generateChunks))
-  offset += section.size
+  for (offset, section), contents in zip(sections, parallelMap(lz77.inflateLz77Blocks, readSections(), workers)):
+   yield WbiChunk(section.addr, section.virt, section.osize, MemoryFile(contents))
+ else:
+  for offset, section in sections:
+   def generateChunks(offset=offset, section=section):
+    # Memory-backed files are decoded in place, the others are read one section at a time
+    part = FilePart(file, offset, section.size)
+    data = getBuffer(part)
+    if data is None:
+     data = memoryview(part.read())
+    pos = 0
+    read = 0
+    while read < section.osize:
+     contents = bytearray()
+     pos = lz77.inflateLz77Into(data, contents, pos)
+     yield contents
+     read += len(contents)
+
+   yield WbiChunk(section.addr, section.virt, section.osize, ChunkedFile(generateChunks))
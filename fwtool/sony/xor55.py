@@ -1,29 +1,119 @@
-import io
+import os
 
 try:
  from Cryptodome.Util.strxor import strxor
 except ImportError:
  from Crypto.Util.strxor import strxor
 
+from ..io import *
 from ..util import *
 
+_n = 55
+_prefixSize = 0x10000
+_prefixCache = {}
+
 def _step(a, b):
  c = a - b
  if c & 0x80000000:
   c += 1000000000
  return c & 0xffffffff
 
+# The generator state is kept in one integer with a 64 bit lane per word, so that runs of words can be calculated at once
+def _lanes(n, value):
+ return sum(value << (64 * i) for i in range(n))
+
+_laneMasks = dict((n, (_lanes(n, 0xffffffff), _lanes(n, 1 << 32), _lanes(n, 1))) for n in [24, _n - 48])
+
+def _stepLanes(a, b, n):
+ mask, borrow, ones = _laneMasks[n]
+ c = (a + borrow - b) & mask
+ return (c + ((c >> 31) & ones) * 1000000000) & mask
+
+def _round(state):
+ """Calculates the next n words of the lagged Fibonacci generator"""
+ # Every word depends on the word 24 positions before it, so the words are calculated in runs of 24
+ run = (1 << (64 * 24)) - 1
+ next0 = _stepLanes(state & run, state >> (64 * (_n - 24)), 24)
+ next1 = _stepLanes((state >> (64 * 24)) & run, next0, 24)
+ next2 = _stepLanes(state >> (64 * 48), next1 & ((1 << (64 * (_n - 48))) - 1), _n - 48)
+ return next0 | next1 << (64 * 24) | next2 << (64 * 48)
+
+class Xor55Keystream(object):
+ """The keystream of the xor55 cipher. The beginning of every keystream is cached."""
+ def __init__(self, a, little=False):
+  self._key = (a, little)
+  self._little = little
+  if self._key not in _prefixCache:
+   b = 1
+   state = [0] * (_n - 1) + [a]
+   for i in range(1, _n):
+    state[(21 * i % _n) - 1] = b
+    a, b = b, _step(a, b)
+   state = sum(w << (64 * i) for i, w in enumerate(state))
+   # The first 3 rounds are skipped
+   for i in range(3):
+    state = _round(state)
+   _prefixCache[self._key] = state, b''
+  self._state, self._buffer = _prefixCache[self._key]
+  self._offset = 0
+
+ def copy(self):
+  """Returns an independent keystream at the same position"""
+  keystream = Xor55Keystream.__new__(Xor55Keystream)
+  keystream.__dict__.update(self.__dict__)
+  return keystream
+
+ def tell(self):
+  return self._offset
+
+ def _generate(self, rounds):
+  lanes = []
+  for i in range(rounds):
+   self._state = _round(self._state)
+   lanes.append(self._state.to_bytes(8 * _n, 'little'))
+  lanes = b''.join(lanes)
+  # Keep the lower 4 bytes of every lane
+  words = bytearray(len(lanes) // 2)
+  for i in range(4):
+   words[i::4] = lanes[(i if self._little else 3 - i)::8]
+  return bytes(words)
+
+ def read(self, size):
+  """Returns the next size bytes of the keystream"""
+  data = self._buffer
+  if len(data) < size:
+   data += self._generate((size - len(data) + 4 * _n - 1) // (4 * _n))
+
+  if self._offset == 0 and len(_prefixCache[self._key][1]) < len(data) <= _prefixSize:
+   _prefixCache[self._key] = self._state, data
+
+  self._buffer = data[size:]
+  self._offset += size
+  return data[:size]
+
+ def crypt(self, data):
+  """Xors data with the next len(data) bytes of the keystream"""
+  return strxor(data, self.read(len(data))) if data else b''
+
 def cryptXor55(a, data, little=False):
- dump32 = dump32le if little else dump32be
- n = 55
- b = 1
- state = [0] * (n - 1) + [a]
- for i in range(1, n):
-  state[(21 * i % n) - 1] = b
-  a, b = b, _step(a, b)
- mask = io.BytesIO()
- while mask.tell() < 12 * n + len(data):
-  for i in range(n):
-   state[i] = _step(state[i], state[i - 24])
-   mask.write(dump32(state[i]))
- return strxor(data, mask.getvalue()[12*n:12*n+len(data)])
+ return Xor55Keystream(a, little).crypt(data)
+
+def cryptXor55File(a, file, little=False, chunkSize=0x100000):
+ """Returns a file that decrypts file in chunks while it is read"""
+ file.seek(0, os.SEEK_END)
+ size = file.tell()
+ # checkpoints[i] is the keystream at the start of chunk i
+ checkpoints = [Xor55Keystream(a, little)]
+ def generateChunks(start=0):
+  i = min(start, len(checkpoints) - 1)
+  keystream = checkpoints[i].copy()
+  while i * chunkSize < size:
+   if i == len(checkpoints):
+    checkpoints.append(keystream.copy())
+   if i < start:
+    keystream.read(chunkSize)
+   else:
+    file.seek(i * chunkSize)
+    yield keystream.crypt(file.read(chunkSize))
+   i += 1
+ return ChunkedFile(generateChunks, size, seekableChunks=True)
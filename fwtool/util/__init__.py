@@ -1,9 +1,10 @@
 """Some utility functions to unpack integers"""
 
 import binascii
+import multiprocessing.pool
 import struct
 
-from collections import namedtuple
+from collections import deque, namedtuple, OrderedDict
 
 def parse64be(data):
  return struct.unpack('>Q', data)[0]
@@ -50,12 +51,135 @@ def parse8(data):
 def dump8(value):
  return chr(value)
 
+class Crc32Stream(object):
+ """Calculates a CRC32 incrementally from data or files"""
+ minBufferSize = 0x100000
+ maxBufferSize = 0x800000
+
+ def __init__(self, crc=0):
+  self.crc = crc
+  self.size = 0
+
+ def update(self, data):
+  self.crc = binascii.crc32(data, self.crc) & 0xffffffff
+  self.size += len(data)
+
+ def updateFromFile(self, file):
+  """Reads file from its current position to the end.
+  Memory-backed files are hashed in place, others are read into a reused buffer which grows up to maxBufferSize."""
+  buffer = file.getBuffer() if hasattr(file, 'getBuffer') else None
+  if buffer is not None:
+   pos = file.tell()
+   self.update(buffer[pos:])
+   file.seek(max(len(buffer), pos))
+   return
+
+  buffer = bytearray(self.minBufferSize)
+  while True:
+   if hasattr(file, 'readinto'):
+    n = file.readinto(buffer)
+   else:
+    data = file.read(len(buffer))
+    n = len(data)
+    buffer[:n] = data
+   if not n:
+    break
+   self.update(memoryview(buffer)[:n])
+   if n == len(buffer) and len(buffer) < self.maxBufferSize:
+    buffer = bytearray(2 * len(buffer))
+
 def crc32(*files):
- crc = 0
+ stream = Crc32Stream()
+ for file in files:
+  stream.updateFromFile(file)
+ return stream.crc
+
+def _gf2MatrixTimes(matrix, vector):
+ result = 0
+ i = 0
+ while vector:
+  if vector & 1:
+   result ^= matrix[i]
+  vector >>= 1
+  i += 1
+ return result
+
+def _gf2MatrixSquare(matrix):
+ return [_gf2MatrixTimes(matrix, row) for row in matrix]
+
+def crc32Combine(crc1, crc2, size2):
+ """Returns the CRC32 of two concatenated blocks, given their CRC32s and the size of the second block (see zlib's crc32_combine)"""
+ if size2 <= 0:
+  return crc1
+ # The operator for one zero bit, then two and four zero bits
+ odd = [0xedb88320] + [1 << i for i in range(31)]
+ even = _gf2MatrixSquare(odd)
+ odd = _gf2MatrixSquare(even)
+ # Apply size2 zero bytes to crc1
+ while size2:
+  even = _gf2MatrixSquare(odd)
+  if size2 & 1:
+   crc1 = _gf2MatrixTimes(even, crc1)
+  size2 >>= 1
+  if not size2:
+   break
+  odd = _gf2MatrixSquare(even)
+  if size2 & 1:
+   crc1 = _gf2MatrixTimes(odd, crc1)
+  size2 >>= 1
+ return crc1 ^ crc2
+
+def sum32(*files):
+ """Calculates the sum of all bytes, truncated to 32 bits"""
+ s = 0
  for file in files:
-  for chunk in iter(lambda: file.read(4096), b''):
-   crc = binascii.crc32(chunk, crc)
- return crc & 0xffffffff
+  for chunk in iter(lambda: file.read(0x100000), b''):
+   s += sum(chunk)
+ return s & 0xffffffff
+
+def parallelMap(func, argsList, workers=0, window=0, threads=False):
+ """Calls func(*args) for every item in argsList and yields the results in order.
+ If workers > 0, the calls are distributed to a pool of worker processes (or threads). At most window calls (default: 2 * workers) are in flight at a time."""
+ if workers <= 0:
+  for args in argsList:
+   yield func(*args)
+  return
+
+ if threads:
+  pool = multiprocessing.pool.ThreadPool(workers)
+ else:
+  # The caller may be running threads (e.g. file writers), which must not be forked
+  methods = multiprocessing.get_all_start_methods()
+  pool = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn').Pool(workers)
+ try:
+  pending = deque()
+  for args in argsList:
+   pending.append(pool.apply_async(func, args))
+   if len(pending) >= (window or 2 * workers):
+    yield pending.popleft().get()
+  while pending:
+   yield pending.popleft().get()
+ finally:
+  pool.terminate()
+
+class LruCache(object):
+ """A cache that keeps the size most recently used entries"""
+ def __init__(self, size):
+  self._size = size
+  self._entries = OrderedDict()
+
+ def get(self, key, default=None):
+  if key not in self._entries:
+   return default
+  value = self._entries.pop(key)
+  self._entries[key] = value
+  return value
+
+ def put(self, key, value):
+  self._entries.pop(key, None)
+  self._entries[key] = value
+  while len(self._entries) > self._size:
+   self._entries.popitem(last=False)
 
 class Struct(object):
  LITTLE_ENDIAN = '<'
@@ -71,17 +195,45 @@ class Struct(object):
  def __init__(self, name, fields, byteorder=LITTLE_ENDIAN):
   self.tuple = namedtuple(name, (n for n, fmt in fields if not isinstance(fmt, int)))
   self.format = byteorder + ''.join(self.PADDING % fmt if isinstance(fmt, int) else fmt for n, fmt in fields)
-  self.size = struct.calcsize(self.format)
+  self.struct = struct.Struct(self.format)
+  self.size = self.struct.size
+  self.offsets = {}
+  offset = 0
+  for n, fmt in fields:
+   if not isinstance(fmt, int):
+    self.offsets[n] = offset
+   offset += struct.calcsize(byteorder + (self.PADDING % fmt if isinstance(fmt, int) else fmt))
+
+ def _read(self, file, offset, size):
+  """Returns a buffer and the offset in it to read size bytes at offset from a file"""
+  buffer = file.getBuffer() if hasattr(file, 'getBuffer') else None
+  if buffer is not None:
+   return buffer, offset
+  file.seek(offset)
+  return file.read(size), 0
 
  def unpack(self, data, offset = 0):
-  if isinstance(data, bytes):
-   data = data[offset:offset+self.size]
-  else:
-   data.seek(offset)
-   data = data.read(self.size)
-  if len(data) < self.size:
+  if not isinstance(data, (bytes, bytearray, memoryview)):
+   data, offset = self._read(data, offset, self.size)
+  if offset < 0 or len(data) - offset < self.size:
    return None
-  return self.tuple._make(struct.unpack_from(self.format, data))
+  return self.tuple._make(self.struct.unpack_from(data, offset))
+
+ def unpackFrom(self, buffer, offset=0):
+  """Unpacks a record from a buffer without copying it. The buffer has to be large enough"""
+  return self.tuple._make(self.struct.unpack_from(buffer, offset))
+
+ def iterUnpack(self, data, offset=0, count=-1):
+  """Unpacks consecutive records at offset in data (a buffer or a file). If count is negative, records are unpacked until the end"""
+  if not isinstance(data, (bytes, bytearray, memoryview)):
+   data, offset = self._read(data, offset, count * self.size if count >= 0 else -1)
+  end = len(data) if count < 0 else offset + count * self.size
+  if end > len(data):
+   raise Exception('Not enough data')
+  make = self.tuple._make
+  unpackFrom = self.struct.unpack_from
+  for o in range(offset, end - self.size + 1, self.size):
+   yield make(unpackFrom(data, o))
 
  def pack(self, **kwargs):
-  return struct.pack(self.format, *self.tuple(**kwargs))
+  return self.struct.pack(*self.tuple(**kwargs))
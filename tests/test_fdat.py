@@ -0,0 +1,50 @@
+"""Round trip tests for the FDAT crypters"""
+
+import io
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fwtool.sony import fdat
+
+class AesCbcCrypterTest(unittest.TestCase):
+ crypterName = 'CXD90045'
+
+ def setUp(self):
+  plain = io.BytesIO()
+  fdat.writeFdat(fdat.FdatFile(
+   model = 0x61020023,
+   region = 0x10,
+   version = '1.00',
+   isAccessory = False,
+   firmware = io.BytesIO(os.urandom(70001)),
+   fs = io.BytesIO(os.urandom(3 * 0x100000 + 5)),
+  ), plain)
+  self.plain = plain.getvalue()
+
+ def testRoundTrip(self):
+  # Full image, exactly one block, exactly one batch
+  for data in [self.plain, self.plain[:1020], self.plain[:fdat.Crypter.batchBlocks * 1020]]:
+   encrypted = fdat.encryptFdat(io.BytesIO(data), self.crypterName).read()
+   crypterName, decrypted = fdat.decryptFdat(io.BytesIO(encrypted))
+   self.assertEqual(crypterName, self.crypterName)
+   self.assertEqual(decrypted.read(), data)
+
+ def testOneBlock(self):
+  # One block and the footer with the IV and the signature
+  encrypted = fdat.encryptFdat(io.BytesIO(self.plain[:1020]), self.crypterName).read()
+  self.assertEqual(len(encrypted), 1024 + 0x110)
+
+ def testSigned(self):
+  self.assertTrue(fdat.isSignedCrypter(self.crypterName))
+  self.assertFalse(fdat.isSignedCrypter('CXD90014'))
+
+ def testRandomIv(self):
+  encrypted1 = fdat.encryptFdat(io.BytesIO(self.plain), self.crypterName).read()
+  encrypted2 = fdat.encryptFdat(io.BytesIO(self.plain), self.crypterName).read()
+  self.assertNotEqual(encrypted1, encrypted2)
+
+if __name__ == '__main__':
+ unittest.main()
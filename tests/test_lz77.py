@@ -0,0 +1,122 @@
+"""Tests for the LZ77 decompressor"""
+
+import io
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fwtool import lz77
+
+def oldInflateLz77(file):
+ """The original decoder, which builds its output with bytes concatenation"""
+ type = ord(file.read(1))
+
+ if type == 0x0f:
+  file.read(1)
+  data = file.read(2)
+  l = ord(data[0:1]) | ord(data[1:2]) << 8
+  return file.read(l)
+ elif type == 0xf0:
+  out = b''
+  lengths = list(range(3, 17)) + [32, 64]
+
+  while True:
+   flags = ord(file.read(1))
+
+   if flags == 0:
+    # special case to improve performance
+    out += file.read(8)
+   else:
+    for i in range(8):
+     if (flags >> i) & 0x1:
+      data = file.read(2)
+      l = lengths[ord(data[0:1]) >> 4]
+      bd = (ord(data[0:1]) & 0xf) << 8 | ord(data[1:2])
+
+      if bd == 0:
+       return out
+
+      d = out[-bd:]
+      d *= l // len(d) + 1
+      out += d[:l]
+     else:
+      out += file.read(1)
+ else:
+  raise Exception('Unknown type')
+
+def storeLz77(data):
+ """Creates an uncompressed stream"""
+ return b'\x0f\x00' + bytearray([len(data) & 0xff, len(data) >> 8]) + data
+
+def compressLz77(tokens):
+ """Creates a compressed stream from a list of literal bytes and (length index, distance) back-references"""
+ tokens = tokens + [(0, 0)]
+ out = bytearray([0xf0])
+ for i in range(0, len(tokens), 8):
+  group = tokens[i:i+8]
+  out.append(sum(1 << j for j, t in enumerate(group) if isinstance(t, tuple)))
+  for t in group:
+   if isinstance(t, tuple):
+    out += bytearray([t[0] << 4 | t[1] >> 8, t[1] & 0xff])
+   else:
+    out.append(t)
+ return bytes(out)
+
+def randomTokens(rnd, count):
+ tokens = []
+ size = 0
+ for i in range(count):
+  if size > 0 and rnd.random() < .3:
+   # Distances shorter than the length produce overlapping copies
+   bd = rnd.randrange(1, min(size, 0xfff) + 1) if rnd.random() < .5 else rnd.randrange(1, min(size, 4) + 1)
+   l = rnd.randrange(16)
+   tokens.append((l, bd))
+   size += (list(range(3, 17)) + [32, 64])[l]
+  else:
+   tokens.append(rnd.randrange(256) if rnd.random() < .5 else 0)
+   size += 1
+ return tokens
+
+class Lz77Test(unittest.TestCase):
+ def testStored(self):
+  data = os.urandom(1000)
+  stream = storeLz77(data)
+  self.assertEqual(lz77.inflateLz77(io.BytesIO(stream + b'garbage')), data)
+  self.assertEqual(lz77.inflateLz77(io.BytesIO(stream)), oldInflateLz77(io.BytesIO(stream)))
+
+ def testOverlappingCopy(self):
+  # 'ab' repeated by a distance 2, length 64 reference, then a distance 1, length 16 reference
+  stream = compressLz77([ord('a'), ord('b'), (15, 2), ord('c'), (13, 1)])
+  expected = b'ab' + b'ab' * 32 + b'c' + b'c' * 16
+  self.assertEqual(oldInflateLz77(io.BytesIO(stream)), expected)
+  self.assertEqual(lz77.inflateLz77(io.BytesIO(stream)), expected)
+
+ def testCompressed(self):
+  rnd = random.Random(0)
+  for i in range(20):
+   stream = compressLz77(randomTokens(rnd, rnd.randrange(1, 2000)))
+   file = io.BytesIO(stream + b'garbage')
+   self.assertEqual(lz77.inflateLz77(file), oldInflateLz77(io.BytesIO(stream)))
+   self.assertEqual(file.tell(), len(stream))
+
+ def testLargeStream(self):
+  # Larger than the initial read of inflateLz77
+  stream = compressLz77(randomTokens(random.Random(1), 100000))
+  self.assertGreater(len(stream), 0x10000)
+  self.assertEqual(lz77.inflateLz77(io.BytesIO(stream)), oldInflateLz77(io.BytesIO(stream)))
+
+ def testBlocks(self):
+  rnd = random.Random(2)
+  streams = [compressLz77(randomTokens(rnd, 500)), storeLz77(os.urandom(300)), compressLz77(randomTokens(rnd, 500))]
+  expected = b''.join(oldInflateLz77(io.BytesIO(s)) for s in streams)
+  self.assertEqual(lz77.inflateLz77Blocks(b''.join(streams), len(expected)), expected)
+
+ def testTruncated(self):
+  stream = compressLz77(randomTokens(random.Random(3), 100))
+  self.assertRaises(Exception, lz77.inflateLz77, io.BytesIO(stream[:-1]))
+
+if __name__ == '__main__':
+ unittest.main()